@@ -11,15 +11,25 @@ import csv
 import io
 import re
 import json
+import time
+import hashlib
+import codecs
+import pickle
+import bisect
+import heapq
+import gc
+from collections import OrderedDict
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
 import signal
+import threading
 import sys
 from datetime import datetime, timedelta
-from typing import Dict, List, Tuple, Optional
-import requests
-import requests.adapters
+from typing import Dict, List, Tuple, Optional, Mapping, NamedTuple
+from types import MappingProxyType
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton, InputFile
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
 import pandas as pd
+import numpy as np
 from io import BytesIO
 import smtplib
 from email.mime.multipart import MIMEMultipart
@@ -67,19 +77,43 @@ ROSSETI_YUG_BRANCHES = [
 csv_cache = {}
 csv_cache_time = {}
 CSV_CACHE_DURATION = timedelta(hours=2)  # Кэш на 2 часа
-
-# Индексы для быстрого поиска
+# Валидаторы загруженных CSV (ETag, Last-Modified, SHA-256 содержимого) для условных запросов
+csv_cache_meta = {}
+# Версия данных справочника (меняется только при новом содержимом, а не при продлении кэша)
+csv_cache_version = {}
+# Фоновое обновление: за сколько до истечения кэша обновлять, как часто проверять,
+# через сколько повторять после ошибки
+CSV_REFRESH_AHEAD = timedelta(minutes=int(os.environ.get('CSV_REFRESH_AHEAD_MINUTES', '10')))
+CSV_REFRESH_CHECK_INTERVAL = int(os.environ.get('CSV_REFRESH_CHECK_INTERVAL', '60'))
+CSV_REFRESH_RETRY_DELAY = timedelta(seconds=int(os.environ.get('CSV_REFRESH_RETRY_DELAY', '60')))
+# URL -> задача фонового обновления
+csv_refresh_tasks = {}
+# (URL, загрузчик) -> идущая загрузка (одновременные запросы одного URL ждут одну загрузку).
+# Загрузчик в ключе нужен, чтобы фоновое обновление не присоединилось к подъему из снимка
+csv_fetch_tasks = {}
+# Бюджет памяти кэша CSV в МБ (0 - без ограничения); справочники, к которым обращались
+# за последние CSV_CACHE_PIN_SECONDS, не вытесняются
+CSV_CACHE_MEMORY_BUDGET_MB = int(os.environ.get('CSV_CACHE_MEMORY_BUDGET_MB', '512'))
+CSV_CACHE_PIN_SECONDS = int(os.environ.get('CSV_CACHE_PIN_SECONDS', '600'))
+# URL -> оценка занимаемой памяти (байт) и время последнего обращения (time.monotonic)
+csv_cache_size = {}
+csv_cache_last_access = {}
+csv_cache_evictions = {'count': 0}
+# URL -> статистика обновлений (успешные, ошибки, длительность, последняя ошибка)
+csv_refresh_stats = {}
+
+# Индексы для быстрого поиска ТП (по URL, перестраиваются при обновлении кэша)
 csv_index_cache = {}
 
-# Пул соединений для requests (для загрузки пользователей)
-session = requests.Session()
-adapter = requests.adapters.HTTPAdapter(
-    pool_connections=10,
-    pool_maxsize=20,
-    max_retries=3
-)
-session.mount('http://', adapter)
-session.mount('https://', adapter)
+# LRU-кэш результатов поиска ТП: (URL, версия справочника, нормализованный запрос, РЭС, режим) -> результат
+search_results_cache = OrderedDict()
+SEARCH_RESULTS_CACHE_SIZE = int(os.environ.get('SEARCH_RESULTS_CACHE_SIZE', '512'))
+search_cache_stats = {'hits': 0, 'misses': 0}
+# Поиск выполняется в потоках (asyncio.to_thread) - кэш результатов защищен блокировкой
+search_results_cache_lock = threading.Lock()
+# Сколько лучших ТП показывать: в колонке двойного поиска и в списке выбора для уведомления
+DUAL_SEARCH_TOP_K = (MAX_BUTTONS_BEFORE_BACK - 2) // 2
+TP_SELECTION_TOP_K = MAX_BUTTONS_BEFORE_BACK - 1
 
 # ==================== СУЩЕСТВУЮЩИЕ ГЛОБАЛЬНЫЕ ПЕРЕМЕННЫЕ ====================
 # Хранилище уведомлений
@@ -91,9 +125,24 @@ notifications_storage = {
 # Состояния пользователей
 user_states = {}
 
-# Кеш данных пользователей
-users_cache = {}
-users_cache_backup = {}
+# Кеш данных пользователей: неизменяемый снимок, который при перезагрузке подменяется целиком
+class UsersSnapshot(NamedTuple):
+    """Справочник пользователей на момент загрузки"""
+    version: int
+    # Telegram ID -> данные пользователя
+    users: Mapping[str, Mapping]
+    # Нормализованный филиал/РЭС -> Telegram ID ответственных
+    by_responsible: Mapping[str, Tuple[str, ...]]
+    # Версия CSV в кэше, из которой собран снимок (одинаковая версия - пересобирать незачем)
+    source_version: int = 0
+
+users_snapshot = UsersSnapshot(0, MappingProxyType({}), MappingProxyType({}))
+# Фоновая загрузка пользователей (если права запросили до первой загрузки)
+users_load_task = None
+# Периодичность проверки справочника пользователей (сек) и запрос внеочередной проверки (/reload)
+USERS_REFRESH_INTERVAL = 300
+users_reload_event = asyncio.Event()
+users_reload_waiters: List[asyncio.Future] = []
 
 # Последние сгенерированные отчеты
 last_reports = {}
@@ -107,6 +156,13 @@ user_activity = {}
 
 # Словарь для отслеживания кто запускал бота
 bot_users = {}
+# Изменения bot_users копятся и пишутся в файл одним разом в фоновом потоке:
+# номер последнего изменения, номер записанного в файл и то, что записано
+bot_users_generation = 0
+bot_users_saved_generation = 0
+bot_users_saved_payload = None
+bot_users_save_lock = threading.Lock()
+bot_users_save_task = None
 
 # Справочные документы
 REFERENCE_DOCS = {
@@ -122,6 +178,10 @@ REFERENCE_DOCS = {
 USER_GUIDE_URL = os.environ.get('USER_GUIDE_URL', 'https://your-domain.com/vols-guide')
 
 BOT_USERS_FILE = os.environ.get('BOT_USERS_FILE', 'bot_users.json')
+# Через сколько секунд после изменения bot_users записывать файл (изменения за это время объединяются)
+BOT_USERS_SAVE_DELAY = float(os.environ.get('BOT_USERS_SAVE_DELAY', '5'))
+# Каталог снимков справочников для быстрого перезапуска (пустое значение - снимки отключены)
+CSV_SNAPSHOT_DIR = os.environ.get('CSV_SNAPSHOT_DIR', 'csv_snapshots')
 
 # ЧАСТЬ 1 ==================== конец==================== ============================================================================================================
 # ЧАСТЬ 2 ==================== УЛУЧШЕННЫЕ ФУНКЦИИ ПОИСКА ============================================================================================================
@@ -154,139 +214,744 @@ def normalize_tp_name_advanced(name: str) -> str:
     
     return name
 
-def search_tp_in_data_advanced(tp_query: str, data: List[Dict], column: str) -> List[Dict]:
-    """Гибкий поиск ТП с поддержкой частичных совпадений и сложных названий"""
-    if not tp_query or not data:
-        return []
+def search_tp_ranked(tp_query: str, data: List[Dict], column: str, user_res: str = None, limit: int = DUAL_SEARCH_TOP_K) -> Dict:
+    """Лучшие limit названий ТП по релевантности (вместо всех совпадений в порядке файла)
     
+    Возвращает {'names': названия по убыванию релевантности, 'rows': строки этих ТП,
+                'total': найдено названий, 'exact': False если total - нижняя граница}"""
+    if not tp_query or not data:
+        return {'names': [], 'rows': [], 'total': 0, 'exact': True}
+    
+    index = get_tp_search_index(data, column)
+    
+    cache_key = get_search_cache_key(index, tp_query, user_res, f'top{limit}')
+    cached = get_cached_search_result(cache_key)
+    if cached is None:
+        cached = rank_tp_names_in_index(tp_query, index, user_res, limit)
+        store_search_result(cache_key, cached)
+    
+    names, rows, total, exact = cached
+    logger.info(f"[search_tp_ranked] Запрос: '{tp_query}', РЭС: {user_res or 'All'}, найдено ТП: {total}{'' if exact else '+'}, показано: {len(names)}")
+    return {'names': list(names), 'rows': list(rows), 'total': total, 'exact': exact}
+
+def get_search_cache_key(index: Dict, tp_query: str, user_res: str, mode: str) -> Optional[Tuple]:
+    """Ключ кэша результатов (только для справочников из csv_cache - у временных индексов нет URL)"""
+    url = index.get('url')
+    if not url:
+        return None
+    return (url, csv_cache_version.get(url), normalize_tp_name_advanced(tp_query), user_res or 'All', mode)
+
+def get_cached_search_result(cache_key: Optional[Tuple]):
+    """Результат из кэша поиска (None если его там нет)"""
+    if not cache_key:
+        return None
+    with search_results_cache_lock:
+        cached = search_results_cache.get(cache_key)
+        if cached is None:
+            search_cache_stats['misses'] += 1
+            return None
+        search_results_cache.move_to_end(cache_key)
+        search_cache_stats['hits'] += 1
+        return cached
+
+def store_search_result(cache_key: Optional[Tuple], result):
+    """Сохранить неизменяемый результат в кэш поиска, вытесняя самые старые"""
+    if not cache_key:
+        return
+    with search_results_cache_lock:
+        search_results_cache[cache_key] = result
+        while len(search_results_cache) > SEARCH_RESULTS_CACHE_SIZE:
+            search_results_cache.popitem(last=False)
+
+def invalidate_search_results_cache(url: str):
+    """Удалить из кэша результаты поиска по справочнику url (после его обновления)"""
+    with search_results_cache_lock:
+        for cache_key in [key for key in search_results_cache if key[0] == url]:
+            del search_results_cache[cache_key]
+
+def prepare_tp_query(tp_query: str) -> Dict:
+    """Подготовить все формы поискового запроса (вычисляются один раз на запрос)"""
     # Нормализуем запрос
     normalized_query = normalize_tp_name_advanced(tp_query)
     
     # Создаем версию запроса без дефисов и пробелов для гибкого поиска
     query_compact = normalized_query.replace('-', '').replace(' ', '').replace('/', '')
     
-    # НОВОЕ: Создаем упрощенную версию запроса для кабельных линий
-    query_simplified = simplify_cable_name(normalized_query)
+    return {
+        'normalized': normalized_query,
+        'compact': query_compact,
+        # Упрощенная версия запроса для кабельных линий
+        'simplified': simplify_cable_name(normalized_query),
+        # Буквенные и цифровые части
+        'letter_parts': re.findall(r'[А-ЯA-Z]+', query_compact),
+        'digit_parts': re.findall(r'\d+', query_compact),
+        'has_cable_marker': 'КЛ' in normalized_query,
+        'cable_params': extract_cable_params(normalized_query),
+    }
+
+# Оценки релевантности по сработавшему правилу поиска (0 - нет совпадения)
+TP_SCORE_EXACT = 5
+TP_SCORE_COMPACT_EXACT = 4
+TP_SCORE_CABLE_SIMPLIFIED = 3
+TP_SCORE_SUBSTRING = 2
+TP_SCORE_PART_MATCH = 1
+
+def match_tp_entry(query: Dict, entry: Tuple) -> int:
+    """Оценить запись индекса по всем правилам поиска ТП (на предвычисленных полях)
+    
+    Возвращает оценку первого сработавшего правила или 0, если ТП не подходит."""
+    normalized_tp, tp_compact, tp_simplified, tp_letter_parts, tp_digit_parts, tp_has_cable_marker, tp_cable_params = entry
+    
+    normalized_query = query['normalized']
+    query_compact = query['compact']
+    query_simplified = query['simplified']
+    query_letter_parts = query['letter_parts']
+    query_digit_parts = query['digit_parts']
+    
+    # 1. Точное совпадение (с учетом дефисов)
+    if normalized_query == normalized_tp:
+        return TP_SCORE_EXACT
+    
+    # 2. Точное совпадение без дефисов
+    if query_compact == tp_compact:
+        return TP_SCORE_COMPACT_EXACT
+    
+    # 3. Совпадение упрощенных версий для кабельных линий
+    if query_simplified and tp_simplified and query_simplified in tp_simplified:
+        return TP_SCORE_CABLE_SIMPLIFIED
+    
+    # 4. Поиск вхождения компактной версии
+    if len(query_compact) >= 4 and query_compact in tp_compact:
+        return TP_SCORE_SUBSTRING
+    
+    # 5. Поиск ключевых слов для кабельных линий
+    if (query['has_cable_marker'] or tp_has_cable_marker) and cable_params_match(query['cable_params'], tp_cable_params):
+        return TP_SCORE_PART_MATCH
+    
+    # 6. Гибкий поиск по частям
+    if query_letter_parts:
+        # Ищем все буквенные части запроса в названии ТП
+        for query_letters in query_letter_parts:
+            if not any(query_letters in tp_letters or tp_letters in query_letters for tp_letters in tp_letter_parts):
+                return 0
+        
+        # Если в запросе нет цифр, но все буквы найдены
+        if not query_digit_parts:
+            return TP_SCORE_PART_MATCH
+        
+        if len(query_digit_parts) == 1:
+            digits_match = any(tp_digit.startswith(query_digit_parts[0]) for tp_digit in tp_digit_parts)
+        # Если в запросе несколько групп цифр - сравниваем группы по порядку
+        elif len(query_digit_parts) > len(tp_digit_parts):
+            digits_match = False
+        else:
+            digits_match = all(tp_digit_parts[i].startswith(query_digit) for i, query_digit in enumerate(query_digit_parts))
+        return TP_SCORE_PART_MATCH if digits_match else 0
+    
+    # 7. Если в запросе только цифры
+    if query_digit_parts:
+        query_digits_str = ''.join(query_digit_parts)
+        if any(tp_digit.startswith(query_digits_str) for tp_digit in tp_digit_parts):
+            return TP_SCORE_PART_MATCH
+    
+    return 0
+
+# Длина n-грамм инвертированного индекса
+TP_NGRAM_SIZE = 3
+
+def tp_ngrams(value: str) -> set:
+    """Все n-граммы строки (для инвертированного индекса)"""
+    return {value[i:i + TP_NGRAM_SIZE] for i in range(len(value) - TP_NGRAM_SIZE + 1)}
+
+def new_tp_search_index(data: List[Dict], column: str = 'Наименование ТП') -> Dict:
+    """Создать пустой индекс поиска ТП для списка строк data"""
+    return {
+        'data': data,
+        'column': column,
+        # Кортежи (нормализованное, компактное, упрощенное, буквенные части,
+        #          цифровые части, признак КЛ, параметры КЛ)
+        'entries': [],
+        # Позиции строк CSV для каждой записи
+        'entry_rows': [],
+        'entry_ids': {},
+        # Компактное название -> номера записей (правила 1-2)
+        'compact_exact': {},
+        # n-грамма компактного/упрощенного названия -> номера записей (правила 3-4)
+        'ngrams': {},
+        # Буквенная часть -> номера записей (правило 6)
+        'letter_parts': {},
+        # Цифровая группа -> номера записей (правила 6-7)
+        'digit_parts': {},
+        # Отсортированные цифровые группы для поиска по префиксу (бинарный поиск)
+        'digit_keys': [],
+        # Упрощенные названия через перевод строки и их смещения - для подстрок короче n-граммы
+        'simplified_haystack': '',
+        'simplified_offsets': [],
+        # Записи КЛ с выделенной подстанцией (правило 5)
+        'cable_with_station': set(),
+        'cable_marked_with_station': set(),
+        # Точное название ТП и название без префикса "1)" -> строки CSV
+        'rows_by_tp_name': {},
+        'rows_by_clean_tp_name': {},
+        # Отсортированные уникальные ВЛ по ТП
+        'vl_by_tp_name': {},
+        # РЭС -> номера записей, у которых есть строки этого РЭС (фильтр кандидатов
+        # для пользователей с ограничением по РЭС)
+        'res_entries': {},
+        # Словарь удалений для нечеткого поиска (если он включен)
+        'fuzzy_deletes': None,
+        # Колоночные таблицы для движка pandas (если выбран этот движок)
+        'frames': None,
+    }
+
+def build_tp_search_index(data: List[Dict], column: str = 'Наименование ТП') -> Dict:
+    """Построить индекс поиска ТП: нормализованные формы названий вычисляются один раз при загрузке CSV
     
-    # Извлекаем все буквенные и цифровые части
-    query_letter_parts = re.findall(r'[А-ЯA-Z]+', query_compact)
-    query_digit_parts = re.findall(r'\d+', query_compact)
+    Все производные формы зависят только от нормализованного названия, поэтому
+    записи индекса хранятся по уникальным названиям, а строки CSV - списком позиций."""
+    index = new_tp_search_index(data, column)
     
-    results = []
-    # ИСПРАВЛЕНО: Убрали seen_tp - больше не фильтруем дубликаты!
+    for position, row in enumerate(data):
+        add_row_to_tp_search_index(index, position, row)
     
-    for row in data:
-        tp_name_original = row.get(column, '')
-        if not tp_name_original:
-            continue
-        
-        # НОВОЕ: Убираем префиксы перед нормализацией
-        tp_name_clean = re.sub(r'^\d+\)\s*', '', tp_name_original)
-        normalized_tp = normalize_tp_name_advanced(tp_name_clean)
-        tp_compact = normalized_tp.replace('-', '').replace(' ', '').replace('/', '')
-        
-        # НОВОЕ: Упрощенная версия для кабельных линий
-        tp_simplified = simplify_cable_name(normalized_tp)
-        
-        # Извлекаем буквенные и цифровые части из названия ТП
-        tp_letter_parts = re.findall(r'[А-ЯA-Z]+', tp_compact)
-        tp_digit_parts = re.findall(r'\d+', tp_compact)
-        
-        # 1. Точное совпадение (с учетом дефисов)
-        if normalized_query == normalized_tp:
-            # ИСПРАВЛЕНО: убрали проверку seen_tp
-            results.append(row)
-            continue
+    finalize_tp_search_index(index)
+    return index
+
+def add_row_to_tp_search_index(index: Dict, position: int, row: Dict, prepared: Tuple = None):
+    """Добавить строку CSV (уже лежащую в index['data'][position]) в индекс"""
+    tp_name_original = row.get(index['column'], '')
+    
+    if tp_name_original:
+        if prepared is None:
+            # Убираем префиксы перед нормализацией
+            tp_name_clean = re.sub(r'^\d+\)\s*', '', tp_name_original)
+            prepared = (tp_name_clean, normalize_tp_name_advanced(tp_name_clean))
+        tp_name_clean, normalized_tp = prepared
         
-        # 2. Точное совпадение без дефисов
-        if query_compact == tp_compact:
-            results.append(row)
-            continue
+        entry_id = index['entry_ids'].get(normalized_tp)
+        if entry_id is None:
+            entry_id = len(index['entries'])
+            index['entry_ids'][normalized_tp] = entry_id
+            index['entries'].append(make_tp_index_entry(normalized_tp))
+            index['entry_rows'].append([])
+            add_entry_to_tp_postings(index, entry_id)
         
-        # 3. НОВОЕ: Совпадение упрощенных версий для кабельных линий
-        if query_simplified and tp_simplified and query_simplified in tp_simplified:
-            results.append(row)
-            continue
+        index['entry_rows'][entry_id].append(position)
+        index['res_entries'].setdefault(row.get('РЭС', '').strip(), set()).add(entry_id)
+        index['rows_by_tp_name'].setdefault(tp_name_original, []).append(row)
+        index['rows_by_clean_tp_name'].setdefault(tp_name_clean, []).append(row)
+
+def finalize_tp_search_index(index: Dict):
+    """Построить отсортированные структуры индекса после добавления всех записей"""
+    index['digit_keys'] = sorted(index['digit_parts'])
+    
+    offsets = []
+    offset = 0
+    for entry in index['entries']:
+        offsets.append(offset)
+        offset += len(entry[2]) + 1
+    index['simplified_offsets'] = offsets
+    index['simplified_haystack'] = '\n'.join(entry[2] for entry in index['entries'])
+    
+    for tp_name, rows in index['rows_by_tp_name'].items():
+        index['vl_by_tp_name'][tp_name] = get_unique_vl_list(rows)
+    
+    # Словарь нечеткого поиска и таблицы pandas - тоже здесь (в пуле разбора), а не на первом запросе
+    if TP_FUZZY_SEARCH_ENABLED:
+        index['fuzzy_deletes'] = build_tp_fuzzy_index(index)
+    if TP_SEARCH_ENGINE == 'pandas':
+        index['frames'] = build_tp_search_frames(index)
+
+def get_res_entry_ids(index: Dict, user_res: str = None) -> Optional[set]:
+    """Номера записей раздела РЭС (для 'All' - None, поиск без ограничения)"""
+    if not user_res or user_res == 'All':
+        return None
+    return index['res_entries'].get(user_res, set())
+
+def filter_rows_by_res(rows: List[Dict], user_res: str = None) -> List[Dict]:
+    """Строки только указанного РЭС (для 'All' - все строки)"""
+    if not user_res or user_res == 'All':
+        return list(rows)
+    return [r for r in rows if r.get('РЭС', '').strip() == user_res]
+
+def get_unique_vl_list(rows: List[Dict]) -> List[str]:
+    """Отсортированный список уникальных ВЛ из строк CSV"""
+    return sorted(set(row.get('Наименование ВЛ', '') for row in rows))
+
+def get_tp_rows_from_catalog(url: str, tp_name: str, user_res: str = None, match_clean_name: bool = False) -> List[Dict]:
+    """Все строки справочника с точным названием ТП (поиск по словарю вместо перебора)
+    
+    match_clean_name - если точного совпадения нет, сравнивать названия без префикса "1)"."""
+    index = csv_index_cache.get(url)
+    if not index or not tp_name:
+        return []
+    
+    rows = index['rows_by_tp_name'].get(tp_name)
+    if not rows and match_clean_name:
+        rows = index['rows_by_clean_tp_name'].get(re.sub(r'^\d+\)\s*', '', tp_name))
+    if not rows:
+        return []
+    
+    # Фильтруем по РЭС если нужно
+    return filter_rows_by_res(rows, user_res)
+
+def get_vl_list_from_catalog(url: str, tp_name: str, user_res: str = None) -> List[str]:
+    """Отсортированный список уникальных ВЛ для ТП (для всего справочника - предвычисленный)"""
+    index = csv_index_cache.get(url)
+    if not index:
+        return []
+    
+    if user_res and user_res != 'All':
+        return get_unique_vl_list(get_tp_rows_from_catalog(url, tp_name, user_res))
+    return list(index['vl_by_tp_name'].get(tp_name, []))
+
+def make_tp_index_entry(normalized_tp: str) -> Tuple:
+    """Предвычислить все формы нормализованного названия ТП"""
+    tp_compact = normalized_tp.replace('-', '').replace(' ', '').replace('/', '')
+    return (
+        normalized_tp,
+        tp_compact,
+        simplify_cable_name(normalized_tp),
+        tuple(re.findall(r'[А-ЯA-Z]+', tp_compact)),
+        tuple(re.findall(r'\d+', tp_compact)),
+        'КЛ' in normalized_tp,
+        extract_cable_params(normalized_tp),
+    )
+
+def add_entry_to_tp_postings(index: Dict, entry_id: int):
+    """Добавить запись в инвертированные списки индекса"""
+    _, tp_compact, tp_simplified, tp_letter_parts, tp_digit_parts, tp_has_cable_marker, tp_cable_params = index['entries'][entry_id]
+    
+    index['compact_exact'].setdefault(tp_compact, set()).add(entry_id)
+    
+    for gram in tp_ngrams(tp_compact) | tp_ngrams(tp_simplified):
+        index['ngrams'].setdefault(gram, set()).add(entry_id)
+    
+    for letters in tp_letter_parts:
+        index['letter_parts'].setdefault(letters, set()).add(entry_id)
+    
+    for digits in tp_digit_parts:
+        index['digit_parts'].setdefault(digits, set()).add(entry_id)
+    
+    if tp_cable_params.get('station'):
+        index['cable_with_station'].add(entry_id)
+        if tp_has_cable_marker:
+            index['cable_marked_with_station'].add(entry_id)
+
+def intersect_postings(postings: List[set]) -> set:
+    """Пересечение списков (начиная с самого короткого)"""
+    if not postings:
+        return set()
+    postings = sorted(postings, key=len)
+    return postings[0].intersection(*postings[1:])
+
+def find_entries_by_substring(index: Dict, value: str) -> set:
+    """Кандидаты, содержащие подстроку (пересечение списков n-грамм)"""
+    ngrams = index['ngrams']
+    postings = []
+    for gram in tp_ngrams(value):
+        if gram not in ngrams:
+            return set()
+        postings.append(ngrams[gram])
+    return intersect_postings(postings)
+
+def find_entries_by_short_simplified_substring(index: Dict, value: str) -> set:
+    """Записи, упрощенное название которых содержит подстроку короче n-граммы"""
+    haystack = index['simplified_haystack']
+    offsets = index['simplified_offsets']
+    result = set()
+    
+    position = haystack.find(value)
+    while position != -1:
+        entry_id = bisect.bisect_right(offsets, position) - 1
+        result.add(entry_id)
+        # Переходим к следующему названию
+        next_start = offsets[entry_id + 1] if entry_id + 1 < len(offsets) else len(haystack)
+        position = haystack.find(value, next_start)
+    
+    return result
+
+def find_entries_by_digit_prefix(index: Dict, prefix: str) -> set:
+    """Записи, у которых есть цифровая группа, начинающаяся с prefix (бинарный поиск)"""
+    digit_keys = index['digit_keys']
+    digit_parts = index['digit_parts']
+    result = set()
+    
+    i = bisect.bisect_left(digit_keys, prefix)
+    while i < len(digit_keys) and digit_keys[i].startswith(prefix):
+        result |= digit_parts[digit_keys[i]]
+        i += 1
+    
+    return result
+
+def collect_tp_candidate_tiers(query: Dict, index: Dict):
+    """Кандидаты по уровням релевантности: пары (оценка уровня, записи)
+    
+    Уровни вычисляются лениво. Запись с оценкой не ниже оценки уровня
+    всегда есть среди кандидатов этого или предыдущих уровней."""
+    # 1-2. Точное совпадение (с дефисами и без)
+    yield TP_SCORE_COMPACT_EXACT, set(index['compact_exact'].get(query['compact'], ()))
+    
+    # 3. Вхождение упрощенной версии
+    query_simplified = query['simplified']
+    if len(query_simplified) >= TP_NGRAM_SIZE:
+        yield TP_SCORE_CABLE_SIMPLIFIED, find_entries_by_substring(index, query_simplified)
+    elif query_simplified:
+        yield TP_SCORE_CABLE_SIMPLIFIED, find_entries_by_short_simplified_substring(index, query_simplified)
+    
+    # 4. Вхождение компактной версии
+    if len(query['compact']) >= 4:
+        yield TP_SCORE_SUBSTRING, find_entries_by_substring(index, query['compact'])
+    
+    candidates = set()
+    
+    # 5. Кабельные линии: нужна подстанция и в запросе, и в названии
+    if query['cable_params'].get('station'):
+        if query['has_cable_marker']:
+            candidates |= index['cable_with_station']
+        else:
+            candidates |= index['cable_marked_with_station']
+    
+    query_letter_parts = query['letter_parts']
+    query_digit_parts = query['digit_parts']
+    
+    # 6. Все буквенные части запроса + цифры
+    if query_letter_parts:
+        postings = []
+        for query_letters in query_letter_parts:
+            matched = set()
+            for tp_letters, entry_ids in index['letter_parts'].items():
+                if query_letters in tp_letters or tp_letters in query_letters:
+                    matched |= entry_ids
+            postings.append(matched)
+        if query_digit_parts:
+            postings.append(find_entries_by_digit_prefix(index, query_digit_parts[0]))
+        candidates |= intersect_postings(postings)
+    
+    # 7. Только цифры
+    elif query_digit_parts:
+        candidates |= find_entries_by_digit_prefix(index, ''.join(query_digit_parts))
+    
+    yield TP_SCORE_PART_MATCH, candidates
+
+def get_tp_search_index(data: List[Dict], column: str) -> Dict:
+    """Найти индекс, построенный при загрузке CSV, или построить временный"""
+    # Копия списка: поиск может идти в потоке, пока event loop обновляет справочники
+    for index in list(csv_index_cache.values()):
+        if index['data'] is data and index['column'] == column:
+            return index
+    
+    return build_tp_search_index(data, column)
+
+def rank_tp_entries(query: Dict, index: Dict, limit: int, allowed_ids: Optional[set] = None) -> Tuple[List[int], int, bool]:
+    """Лучшие limit записей индекса: выше оценка, при равной - раньше в файле
+    
+    allowed_ids - искать только среди этих записей (раздел РЭС), None - среди всех.
+    
+    Уровни кандидатов проверяются по очереди, поиск останавливается, как только
+    найдено больше limit записей, которые уже не вытеснить (тогда число найденных -
+    нижняя граница). Возвращает номера записей, число найденных записей и признак
+    точности этого числа."""
+    if TP_SEARCH_ENGINE == 'pandas':
+        return rank_tp_entries_vectorized(query, index, limit, allowed_ids)
+    
+    entries = index['entries']
+    scores = {}
+    
+    tiers = collect_tp_candidate_tiers(query, index)
+    for tier_score, tier_candidates in tiers:
+        if allowed_ids is not None:
+            tier_candidates = tier_candidates & allowed_ids
+        if tier_score == TP_SCORE_PART_MATCH:
+            break
+        for entry_id in tier_candidates:
+            if entry_id not in scores:
+                scores[entry_id] = match_tp_entry(query, entries[entry_id])
         
-        # 4. Поиск вхождения компактной версии
-        if len(query_compact) >= 4 and query_compact in tp_compact:
-            results.append(row)
+        # Все записи с оценкой не ниже tier_score уже найдены; ровно limit - еще не повод
+        # останавливаться, иначе "19+" при ровно 19 найденных
+        settled = sum(1 for score in scores.values() if score >= tier_score)
+        if settled > limit:
+            top = heapq.nsmallest(limit, (entry_id for entry_id, score in scores.items() if score >= tier_score),
+                                  key=lambda entry_id: (-scores[entry_id], entry_id))
+            return top, settled, False
+    else:
+        tier_candidates = set()
+    
+    # Последний уровень: у всех оставшихся оценка минимальная, поэтому идем по порядку
+    # файла (номера записей растут с первым появлением) и останавливаемся на (limit + 1)-й
+    settled = sum(1 for score in scores.values() if score > TP_SCORE_PART_MATCH)
+    ordered = sorted(tier_candidates.union(entry_id for entry_id, score in scores.items() if score == TP_SCORE_PART_MATCH))
+    exact = True
+    for entry_id in ordered:
+        score = scores.get(entry_id)
+        if score is None:
+            score = scores[entry_id] = match_tp_entry(query, entries[entry_id])
+        if score == TP_SCORE_PART_MATCH:
+            settled += 1
+            if settled > limit:
+                exact = False
+                break
+    
+    matched = [entry_id for entry_id, score in scores.items() if score]
+    top = heapq.nsmallest(limit, matched, key=lambda entry_id: (-scores[entry_id], entry_id))
+    return top, settled, exact
+
+def rank_tp_names_in_index(tp_query: str, index: Dict, user_res: str = None, limit: int = DUAL_SEARCH_TOP_K) -> Tuple:
+    """Лучшие названия ТП и их строки: (названия, строки, найдено названий, число точное)
+    
+    Для пользователей с ограничением по РЭС кандидаты и строки берутся только из их РЭС."""
+    allowed_ids = get_res_entry_ids(index, user_res)
+    if allowed_ids is not None and not allowed_ids:
+        return (), (), 0, True
+    
+    query = prepare_tp_query(tp_query)
+    data = index['data']
+    column = index['column']
+    
+    top_entries, total, exact = rank_tp_entries(query, index, limit, allowed_ids)
+    positions = []
+    for entry_id in top_entries:
+        positions.extend(index['entry_rows'][entry_id])
+    
+    # Ничего не нашли - пробуем нечеткий поиск (опечатки вида "ТП-1243" вместо "ТП-1234")
+    if not positions and TP_FUZZY_SEARCH_ENABLED:
+        positions = fuzzy_search_tp_positions(query, index, allowed_ids)
+    
+    # У записи могут быть строки других РЭС
+    rows_in_res = filter_rows_by_res([data[position] for position in positions], user_res)
+    
+    # Несколько вариантов написания могут давать одну запись индекса
+    names = list(dict.fromkeys(row[column] for row in rows_in_res))
+    if exact:
+        total = len(names)
+    else:
+        total = max(total, len(names))
+    names = names[:limit]
+    
+    rows = []
+    for tp_name in names:
+        rows.extend(filter_rows_by_res(index['rows_by_tp_name'][tp_name], user_res))
+    return tuple(names), tuple(rows), total, exact
+
+# ==================== НЕЧЕТКИЙ ПОИСК ТП (ОПЕЧАТКИ) ====================
+
+TP_FUZZY_SEARCH_ENABLED = os.environ.get('TP_FUZZY_SEARCH', '1') == '1'
+TP_FUZZY_TOP_K = int(os.environ.get('TP_FUZZY_TOP_K', '5'))
+TP_FUZZY_MAX_DISTANCE = 2
+TP_FUZZY_MIN_LENGTH = 4
+# Удаления считаются только по префиксу названия (как в SymSpell) - словарь меньше,
+# а опечатки дальше префикса находятся через совпадающий префикс
+TP_FUZZY_PREFIX_LENGTH = 8
+
+def tp_single_deletes(value: str) -> set:
+    """Строка и все ее варианты с одним удаленным символом"""
+    return {value} | {value[:i] + value[i + 1:] for i in range(len(value))}
+
+def build_tp_fuzzy_index(index: Dict) -> Dict:
+    """Словарь удалений SymSpell: вариант префикса компактного названия -> номера записей"""
+    deletes = {}
+    for entry_id, entry in enumerate(index['entries']):
+        tp_compact = entry[1]
+        if len(tp_compact) < TP_FUZZY_MIN_LENGTH:
             continue
-        
-        # 5. НОВОЕ: Поиск ключевых слов для кабельных линий
-        if is_cable_line_match(normalized_query, normalized_tp):
-            results.append(row)
+        for variant in tp_single_deletes(tp_compact[:TP_FUZZY_PREFIX_LENGTH]):
+            deletes.setdefault(variant, []).append(entry_id)
+    return deletes
+
+def osa_distance(first: str, second: str) -> int:
+    """Расстояние Дамерау-Левенштейна (с перестановкой соседних символов)"""
+    previous_previous = None
+    previous = list(range(len(second) + 1))
+    for i in range(1, len(first) + 1):
+        current = [i] + [0] * len(second)
+        for j in range(1, len(second) + 1):
+            cost = 0 if first[i - 1] == second[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if (i > 1 and j > 1 and first[i - 1] == second[j - 2]
+                    and first[i - 2] == second[j - 1]):
+                current[j] = min(current[j], previous_previous[j - 2] + 1)
+        previous_previous, previous = previous, current
+    return previous[len(second)]
+
+def fuzzy_search_tp_positions(query: Dict, index: Dict, allowed_ids: Optional[set] = None) -> List[int]:
+    """Позиции строк для TP_FUZZY_TOP_K ближайших по расстоянию правки названий
+    
+    Строки отсортированы по расстоянию, затем по первому появлению названия в файле.
+    allowed_ids - искать только среди этих записей (раздел РЭС)."""
+    query_compact = query['compact']
+    if len(query_compact) < TP_FUZZY_MIN_LENGTH:
+        return []
+    
+    # Словарь строится вместе с индексом; здесь - только для индекса, построенного
+    # при выключенном нечетком поиске
+    deletes = index.get('fuzzy_deletes')
+    if deletes is None:
+        deletes = build_tp_fuzzy_index(index)
+        index['fuzzy_deletes'] = deletes
+        logger.info(f"🔤 Построен словарь нечеткого поиска: {len(deletes)} вариантов")
+    
+    candidate_ids = set()
+    for variant in tp_single_deletes(query_compact[:TP_FUZZY_PREFIX_LENGTH]):
+        candidate_ids.update(deletes.get(variant, ()))
+    if allowed_ids is not None:
+        candidate_ids &= allowed_ids
+    
+    scored = []
+    for entry_id in candidate_ids:
+        tp_compact = index['entries'][entry_id][1]
+        if abs(len(tp_compact) - len(query_compact)) > TP_FUZZY_MAX_DISTANCE:
             continue
+        distance = osa_distance(query_compact, tp_compact)
+        if distance <= TP_FUZZY_MAX_DISTANCE:
+            scored.append((distance, entry_id))
+    
+    positions = []
+    for distance, entry_id in sorted(scored)[:TP_FUZZY_TOP_K]:
+        positions.extend(index['entry_rows'][entry_id])
+    
+    logger.info(f"🔤 Нечеткий поиск '{query['normalized']}': кандидатов {len(candidate_ids)}, подходящих названий {len(scored)}, строк {len(positions)}")
+    return positions
+
+# ==================== ВЕКТОРИЗОВАННЫЙ ПОИСК ТП (PANDAS) ====================
+
+# Движок поиска: 'index' - инвертированный индекс, 'pandas' - маски по колонкам (для A/B сравнения)
+TP_SEARCH_ENGINE = os.environ.get('TP_SEARCH_ENGINE', 'index')
+
+def build_tp_search_frames(index: Dict) -> Dict:
+    """Колоночные таблицы записей индекса: сами записи, их буквенные и цифровые части"""
+    entries = index['entries']
+    
+    entries_frame = pd.DataFrame({
+        'normalized': pd.Series([entry[0] for entry in entries], dtype=object),
+        'compact': pd.Series([entry[1] for entry in entries], dtype=object),
+        'simplified': pd.Series([entry[2] for entry in entries], dtype=object),
+        'cable_marker': pd.Series([entry[5] for entry in entries], dtype=bool),
+        'voltage': pd.Series([entry[6].get('voltage', '') for entry in entries], dtype=object),
+        'station': pd.Series([entry[6].get('station', '') for entry in entries], dtype=object),
+    })
+    
+    # Части развернуты в отдельные строки: (запись, часть) и (запись, номер группы, цифры)
+    letters_frame = pd.DataFrame({
+        'entry_id': pd.Series([entry_id for entry_id, entry in enumerate(entries) for _ in entry[3]], dtype='int64'),
+        'letters': pd.Series([letters for entry in entries for letters in entry[3]], dtype=object),
+    })
+    digits_frame = pd.DataFrame({
+        'entry_id': pd.Series([entry_id for entry_id, entry in enumerate(entries) for _ in entry[4]], dtype='int64'),
+        'position': pd.Series([position for entry in entries for position in range(len(entry[4]))], dtype='int64'),
+        'digits': pd.Series([digits for entry in entries for digits in entry[4]], dtype=object),
+    })
+    
+    return {'entries': entries_frame, 'letters': letters_frame, 'digits': digits_frame}
+
+def get_all_substrings(value: str) -> set:
+    """Все непустые подстроки (проверка "часть названия входит в запрос" через isin)"""
+    return {value[i:j] for i in range(len(value)) for j in range(i + 1, len(value) + 1)}
+
+def get_entries_mask(parts_frame: pd.DataFrame, rows_mask: pd.Series, count: int) -> np.ndarray:
+    """Маска записей, у которых хотя бы одна часть попала в rows_mask"""
+    mask = np.zeros(count, dtype=bool)
+    mask[parts_frame['entry_id'].to_numpy()[rows_mask.to_numpy(dtype=bool)]] = True
+    return mask
+
+def match_tp_parts_vectorized(query: Dict, frames: Dict, count: int) -> np.ndarray:
+    """Маска правил 6-7 (буквенные и цифровые части)"""
+    letters_frame = frames['letters']
+    digits_frame = frames['digits']
+    query_letter_parts = query['letter_parts']
+    query_digit_parts = query['digit_parts']
+    
+    if query_letter_parts:
+        mask = np.ones(count, dtype=bool)
+        # Каждая буквенная часть запроса должна входить в часть названия или содержать ее
+        for query_letters in query_letter_parts:
+            letters = letters_frame['letters']
+            found = letters.str.contains(query_letters, regex=False) | letters.isin(get_all_substrings(query_letters))
+            mask &= get_entries_mask(letters_frame, found, count)
         
-        # 6. Гибкий поиск по частям (существующая логика)
-        match_found = False
-        
-        # Проверяем буквенные части
-        if query_letter_parts:
-            # Ищем все буквенные части запроса в названии ТП
-            all_letters_found = True
-            for query_letters in query_letter_parts:
-                letter_found = False
-                for tp_letters in tp_letter_parts:
-                    if query_letters in tp_letters or tp_letters in query_letters:
-                        letter_found = True
-                        break
-                if not letter_found:
-                    all_letters_found = False
-                    break
-            
-            if all_letters_found:
-                # Теперь проверяем цифровые части
-                if query_digit_parts:
-                    # Объединяем цифры из запроса
-                    query_digits_str = ''.join(query_digit_parts)
-                    
-                    # Ищем эту последовательность цифр
-                    if len(query_digit_parts) == 1:
-                        digit_found = False
-                        for tp_digit in tp_digit_parts:
-                            if tp_digit.startswith(query_digits_str):
-                                digit_found = True
-                                break
-                        if digit_found:
-                            match_found = True
-                    else:
-                        # Если в запросе несколько групп цифр
-                        digits_match = True
-                        for i, query_digit in enumerate(query_digit_parts):
-                            if i < len(tp_digit_parts):
-                                if not tp_digit_parts[i].startswith(query_digit):
-                                    digits_match = False
-                                    break
-                            else:
-                                digits_match = False
-                                break
-                        if digits_match:
-                            match_found = True
-                else:
-                    # Если в запросе нет цифр, но все буквы найдены
-                    match_found = True
-        
-        # 7. Если в запросе только цифры
-        elif query_digit_parts and not query_letter_parts:
-            query_digits_str = ''.join(query_digit_parts)
-            
-            # Проверяем каждую группу цифр в ТП
-            digit_found = False
-            for tp_digit in tp_digit_parts:
-                if tp_digit.startswith(query_digits_str):
-                    digit_found = True
-                    break
-            
-            if digit_found:
-                match_found = True
-        
-        # ИСПРАВЛЕНО: убрали проверку seen_tp
-        if match_found:
-            results.append(row)
+        if len(query_digit_parts) == 1:
+            mask &= get_entries_mask(digits_frame, digits_frame['digits'].str.startswith(query_digit_parts[0]), count)
+        else:
+            # Несколько групп цифр - сравниваем группы по порядку
+            for position, query_digits in enumerate(query_digit_parts):
+                found = (digits_frame['position'] == position) & digits_frame['digits'].str.startswith(query_digits)
+                mask &= get_entries_mask(digits_frame, found, count)
+        return mask
     
-    logger.info(f"[search_tp_in_data_advanced] Запрос: '{tp_query}', найдено записей: {len(results)}")
-    return results
+    if query_digit_parts:
+        return get_entries_mask(digits_frame, digits_frame['digits'].str.startswith(''.join(query_digit_parts)), count)
+    
+    return np.zeros(count, dtype=bool)
+
+def score_tp_entries_vectorized(query: Dict, index: Dict) -> Tuple[np.ndarray, np.ndarray]:
+    """Оценки всех записей индекса масками pandas: (номера подходящих записей, их оценки)
+    
+    Результат совпадает с match_tp_entry для каждой записи."""
+    # Таблицы строятся вместе с индексом; здесь - только для индекса, построенного другим движком
+    frames = index.get('frames')
+    if frames is None:
+        frames = build_tp_search_frames(index)
+        index['frames'] = frames
+    
+    frame = frames['entries']
+    count = len(frame)
+    no_match = np.zeros(count, dtype=bool)
+    
+    query_compact = query['compact']
+    query_simplified = query['simplified']
+    
+    # 1-2. Точное совпадение (с дефисами и без)
+    exact = (frame['normalized'] == query['normalized']).to_numpy(dtype=bool)
+    compact_exact = (frame['compact'] == query_compact).to_numpy(dtype=bool)
+    
+    # 3. Вхождение упрощенной версии
+    if query_simplified:
+        cable_simplified = frame['simplified'].str.contains(query_simplified, regex=False).to_numpy(dtype=bool)
+    else:
+        cable_simplified = no_match
+    
+    # 4. Вхождение компактной версии
+    if len(query_compact) >= 4:
+        substring = frame['compact'].str.contains(query_compact, regex=False).to_numpy(dtype=bool)
+    else:
+        substring = no_match
+    
+    # 5. Кабельные линии: напряжение не противоречит, подстанции входят одна в другую
+    query_station = query['cable_params'].get('station')
+    if query_station:
+        station = frame['station']
+        cable = (station != '') & (station.str.contains(query_station, regex=False) | station.isin(get_all_substrings(query_station)))
+        if not query['has_cable_marker']:
+            cable &= frame['cable_marker']
+        query_voltage = query['cable_params'].get('voltage')
+        if query_voltage:
+            cable &= (frame['voltage'] == '') | (frame['voltage'] == query_voltage)
+        cable = cable.to_numpy(dtype=bool)
+    else:
+        cable = no_match
+    
+    # 6-7. Буквенные и цифровые части
+    parts = match_tp_parts_vectorized(query, frames, count)
+    
+    # np.select берет первое сработавшее условие - как каскад правил
+    scores = np.select(
+        [exact, compact_exact, cable_simplified, substring, cable, parts],
+        [TP_SCORE_EXACT, TP_SCORE_COMPACT_EXACT, TP_SCORE_CABLE_SIMPLIFIED, TP_SCORE_SUBSTRING, TP_SCORE_PART_MATCH, TP_SCORE_PART_MATCH],
+        default=0,
+    )
+    entry_ids = np.flatnonzero(scores)
+    return entry_ids, scores[entry_ids]
+
+def rank_tp_entries_vectorized(query: Dict, index: Dict, limit: int, allowed_ids: Optional[set] = None) -> Tuple[List[int], int, bool]:
+    """Лучшие limit записей по оценкам pandas (все записи оцениваются сразу)
+    
+    Число названий точно известно, только если в ответ попали все найденные записи."""
+    entry_ids, scores = score_tp_entries_vectorized(query, index)
+    if allowed_ids is not None:
+        in_res = np.isin(entry_ids, np.fromiter(allowed_ids, dtype=entry_ids.dtype, count=len(allowed_ids)))
+        entry_ids, scores = entry_ids[in_res], scores[in_res]
+    order = np.lexsort((entry_ids, -scores))[:limit]
+    return entry_ids[order].tolist(), len(entry_ids), len(entry_ids) <= limit
 
 # НОВЫЕ вспомогательные функции для работы с кабельными линиями
 def simplify_cable_name(name: str) -> str:
@@ -309,16 +974,8 @@ def simplify_cable_name(name: str) -> str:
     
     return simplified
 
-def is_cable_line_match(query: str, tp_name: str) -> bool:
-    """Проверка соответствия для кабельных линий"""
-    # Проверяем, является ли это кабельной линией
-    if not ('КЛ' in query.upper() or 'КЛ' in tp_name.upper()):
-        return False
-    
-    # Извлекаем ключевые параметры кабельной линии
-    query_params = extract_cable_params(query)
-    tp_params = extract_cable_params(tp_name)
-    
+def cable_params_match(query_params: Dict, tp_params: Dict) -> bool:
+    """Сравнение параметров кабельных линий (напряжение и подстанция)"""
     # Сравниваем ключевые параметры
     if query_params and tp_params:
         # Проверяем напряжение
@@ -362,151 +1019,747 @@ def normalize_tp_name(name: str) -> str:
     """Нормализовать название ТП для поиска (старая версия)"""
     return ''.join(filter(str.isdigit, name))
 
-def search_tp_in_data(tp_query: str, data: List[Dict], column: str) -> List[Dict]:
-    """Поиск ТП в данных (использует улучшенную версию)"""
-    return search_tp_in_data_advanced(tp_query, data, column)
+def format_found_count(found: Tuple[int, bool]) -> str:
+    """Число найденных ТП для сообщений: "25" или "19+" (если поиск остановлен досрочно)"""
+    total, exact = found
+    return str(total) if exact else f"{total}+"
+
+async def search_catalog_ranked(url: str, tp_query: str, user_res: str = None) -> Dict:
+    """Загрузить справочник и найти лучшие ТП (поиск в потоке, чтобы не блокировать event loop)"""
+    data = await load_csv_from_url_async(url)
+    return await asyncio.to_thread(search_tp_ranked, tp_query, data, 'Наименование ТП', user_res, DUAL_SEARCH_TOP_K)
 
-# Новая функция для двойного поиска (БЕЗ ИЗМЕНЕНИЙ)
+# Новая функция для двойного поиска
 async def search_tp_in_both_catalogs(tp_query: str, branch: str, network: str, user_res: str = None) -> Dict:
     """Поиск ТП одновременно в реестре договоров и структуре сети
-    ВАЖНО: Возвращает ВСЕ записи для найденных ТП"""
+    ВАЖНО: Возвращает лучшие по релевантности ТП и ВСЕ записи для них"""
     result = {
-        'registry': [],  # ВСЕ результаты из реестра договоров
-        'structure': [],  # ВСЕ результаты из структуры сети
-        'registry_tp_names': [],  # Уникальные названия ТП из реестра
-        'structure_tp_names': []  # Уникальные названия ТП из структуры
+        'registry': [],  # ВСЕ записи показанных ТП из реестра договоров
+        'structure': [],  # ВСЕ записи показанных ТП из структуры сети
+        'registry_tp_names': [],  # Лучшие названия ТП из реестра (по убыванию релевантности)
+        'structure_tp_names': [],  # Лучшие названия ТП из структуры
+        'registry_tp_total': (0, True),  # (найдено ТП, число точное)
+        'structure_tp_total': (0, True)
     }
     
-    # Поиск в реестре договоров (без SP)
-    registry_env_key = get_env_key_for_branch(branch, network, is_reference=False)
-    registry_url = os.environ.get(registry_env_key)
+    registry_env_key = get_env_key_for_branch(branch, network, is_reference=False)  # Реестр договоров (без SP)
+    structure_env_key = get_env_key_for_branch(branch, network, is_reference=True)  # Структура сети (с SP)
     
-    if registry_url:
-        logger.info(f"Поиск в реестре договоров: {registry_env_key}")
-        registry_data = await load_csv_from_url_async(registry_url)
-        registry_results = search_tp_in_data(tp_query, registry_data, 'Наименование ТП')
-        
-        # Фильтруем по РЭС если нужно
-        if user_res and user_res != 'All':
-            registry_results = [r for r in registry_results if r.get('РЭС', '').strip() == user_res]
-        
-        result['registry'] = registry_results
-        result['registry_tp_names'] = list(set([r['Наименование ТП'] for r in registry_results]))
-        logger.info(f"[search_tp_in_both_catalogs] Реестр: найдено {len(registry_results)} записей, {len(result['registry_tp_names'])} уникальных ТП")
-    
-    # Поиск в структуре сети (с SP)
-    structure_env_key = get_env_key_for_branch(branch, network, is_reference=True)
-    structure_url = os.environ.get(structure_env_key)
-    
-    if structure_url:
-        logger.info(f"Поиск в структуре сети: {structure_env_key}")
-        structure_data = await load_csv_from_url_async(structure_url)
-        structure_results = search_tp_in_data(tp_query, structure_data, 'Наименование ТП')
-        
-        # Фильтруем по РЭС если нужно
-        if user_res and user_res != 'All':
-            structure_results = [r for r in structure_results if r.get('РЭС', '').strip() == user_res]
-        
-        result['structure'] = structure_results
-        result['structure_tp_names'] = list(set([r['Наименование ТП'] for r in structure_results]))
-        logger.info(f"[search_tp_in_both_catalogs] Структура: найдено {len(structure_results)} записей, {len(result['structure_tp_names'])} уникальных ТП")
+    # Оба справочника загружаем и ищем одновременно
+    catalogs = []
+    for catalog, env_key in (('registry', registry_env_key), ('structure', structure_env_key)):
+        url = os.environ.get(env_key)
+        if url:
+            logger.info(f"Поиск в справочнике {catalog}: {env_key}")
+            catalogs.append((catalog, url))
+    
+    # Пользователи с ограничением по РЭС ищут только в своем разделе
+    found = await asyncio.gather(*(search_catalog_ranked(url, tp_query, user_res) for catalog, url in catalogs))
+    
+    for (catalog, url), catalog_results in zip(catalogs, found):
+        result[catalog] = catalog_results['rows']
+        result[f'{catalog}_tp_names'] = catalog_results['names']
+        result[f'{catalog}_tp_total'] = (catalog_results['total'], catalog_results['exact'])
+        logger.info(f"[search_tp_in_both_catalogs] {catalog}: найдено {format_found_count(result[f'{catalog}_tp_total'])} ТП, показано {len(result[f'{catalog}_tp_names'])} ТП ({len(result[catalog])} записей)")
     
     return result
 
-# ОСТАЛЬНЫЕ ФУНКЦИИ БЕЗ ИЗМЕНЕНИЙ (load_csv_from_url_async, load_csv_from_url, preload_csv_files)
+# ОСТАЛЬНЫЕ ФУНКЦИИ БЕЗ ИЗМЕНЕНИЙ (load_csv_from_url_async, preload_csv_files)
+
+# ==================== HTTP-СЕССИЯ ====================
+
+# Пул соединений общей сессии (все исходящие HTTP-запросы бота)
+HTTP_CONNECTION_LIMIT = int(os.environ.get('HTTP_CONNECTION_LIMIT', '30'))
+HTTP_CONNECTION_LIMIT_PER_HOST = int(os.environ.get('HTTP_CONNECTION_LIMIT_PER_HOST', '10'))
+HTTP_KEEPALIVE_TIMEOUT = float(os.environ.get('HTTP_KEEPALIVE_TIMEOUT', '60'))
+HTTP_DNS_CACHE_TTL = int(os.environ.get('HTTP_DNS_CACHE_TTL', '300'))
+
+# Создается в post_init, закрывается в post_shutdown
+http_session: Optional[aiohttp.ClientSession] = None
+
+def get_http_session() -> aiohttp.ClientSession:
+    """Общая сессия aiohttp (создается при первом обращении, если post_init еще не отработал)"""
+    global http_session
+    if http_session is None or http_session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_CONNECTION_LIMIT,
+            limit_per_host=HTTP_CONNECTION_LIMIT_PER_HOST,
+            keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+        )
+        http_session = aiohttp.ClientSession(connector=connector)
+        logger.info(f"🌐 Создана HTTP-сессия: до {HTTP_CONNECTION_LIMIT} соединений, до {HTTP_CONNECTION_LIMIT_PER_HOST} на хост")
+    return http_session
+
+async def close_http_session():
+    """Закрыть общую сессию aiohttp (при остановке бота)"""
+    global http_session
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+        logger.info("🌐 HTTP-сессия закрыта")
+    http_session = None
 
 # ==================== АСИНХРОННАЯ ЗАГРУЗКА CSV ====================
 
+def store_csv_in_cache(url: str, data: List[Dict], validators: Dict = None, index: Dict = None, size: int = None):
+    """Сохранить CSV в кэш и перестроить индекс поиска ТП для этого URL
+    
+    validators - ETag, Last-Modified и хэш содержимого для последующих условных запросов
+    index, size - индекс и оценка памяти, уже посчитанные в пуле разбора (иначе считаются здесь)"""
+    # Индекс строится заранее, а затем данные и индекс подменяются вместе
+    if index is None and data and 'Наименование ТП' in data[0]:
+        index = build_tp_search_index(data)
+    if index:
+        index['url'] = url
+        logger.info(f"🗂️ Построен индекс поиска ТП: {len(data)} строк, {len(index['entries'])} уникальных названий")
+    
+    if index:
+        csv_index_cache[url] = index
+    else:
+        csv_index_cache.pop(url, None)
+    csv_cache[url] = data
+    csv_cache_time[url] = datetime.now()
+    csv_cache_meta[url] = validators or {}
+    csv_cache_version[url] = csv_cache_version.get(url, 0) + 1
+    invalidate_search_results_cache(url)
+    
+    csv_cache_size[url] = size if size is not None else estimate_catalog_size(data, index)
+    enforce_csv_memory_budget(keep_url=url)
+
+def get_revalidation_headers(url: str) -> Dict:
+    """Заголовки условного запроса для закэшированного CSV (пустые, если кэша нет)"""
+    if url not in csv_cache:
+        return {}
+    
+    meta = csv_cache_meta.get(url, {})
+    headers = {}
+    if meta.get('etag'):
+        headers['If-None-Match'] = meta['etag']
+    if meta.get('last_modified'):
+        headers['If-Modified-Since'] = meta['last_modified']
+    return headers
+
+def extend_csv_cache_ttl(url: str, validators: Dict = None):
+    """Продлить кэш неизменившегося CSV без повторного разбора и перестройки индекса"""
+    csv_cache_time[url] = datetime.now()
+    if validators:
+        csv_cache_meta[url] = validators
+
+class CatalogRow:
+    """Компактная строка CSV: общий для всего файла словарь колонок + кортеж значений
+    
+    Читается как dict (get, [], in, keys, items), поэтому код, работавший со строками-словарями,
+    не меняется. Значения интернированы - одинаковые РЭС, филиалы и т.п. хранятся один раз."""
+    __slots__ = ('_columns', '_values')
+    
+    def __init__(self, columns: Dict[str, int], values: Tuple[str, ...]):
+        self._columns = columns
+        self._values = values
+    
+    def get(self, key: str, default=None):
+        position = self._columns.get(key)
+        return default if position is None else self._values[position]
+    
+    def __getitem__(self, key: str) -> str:
+        return self._values[self._columns[key]]
+    
+    def __contains__(self, key: str) -> bool:
+        return key in self._columns
+    
+    def __iter__(self):
+        return iter(self._columns)
+    
+    def __len__(self) -> int:
+        return len(self._columns)
+    
+    def keys(self):
+        return self._columns.keys()
+    
+    def values(self) -> List[str]:
+        return [self._values[position] for position in self._columns.values()]
+    
+    def items(self) -> List[Tuple[str, str]]:
+        return [(key, self._values[position]) for key, position in self._columns.items()]
+    
+    def __repr__(self) -> str:
+        return f"CatalogRow({dict(self.items())!r})"
+    
+    def __reduce__(self):
+        # Для pickle: словарь колонок в снимке сохраняется один раз на файл
+        return (CatalogRow, (self._columns, self._values))
+
+def make_catalog_row_builder(header: List[str]):
+    """Функция, превращающая список значений CSV в CatalogRow с общими колонками файла
+    
+    Лишние значения отбрасываются, недостающие заполняются пустыми строками."""
+    # При повторе имени колонки берется последняя (как в csv.DictReader)
+    columns = {sys.intern(name.strip()): position for position, name in enumerate(header)}
+    width = len(header)
+    empty = ('',) * width
+    
+    def build_row(values: List[str]) -> CatalogRow:
+        values = tuple(sys.intern(value.strip()) for value in values[:width])
+        return CatalogRow(columns, values + empty[len(values):])
+    
+    return build_row
+
+# Размер куска при потоковом чтении CSV из ответа
+CSV_STREAM_CHUNK_SIZE = 64 * 1024
+
+class CsvStreamParser:
+    """Потоковый разбор CSV: куски байт -> записи (списки значений) без сборки всего текста
+    
+    Декодирует utf-8-sig (BOM отбрасывается) и отдает только записи, закрытые переводом строки
+    вне кавычек, поэтому поля с переводами строк внутри кавычек не разрываются."""
+    
+    def __init__(self):
+        self._decoder = codecs.getincrementaldecoder('utf-8-sig')()
+        self._pending = ''
+    
+    def feed(self, chunk: bytes) -> List[List[str]]:
+        """Добавить кусок, вернуть записи, которые в нем завершились"""
+        self._pending += self._decoder.decode(chunk)
+        
+        # Ищем последний перевод строки, перед которым четное число кавычек
+        cut = -1
+        quotes = 0
+        start = 0
+        while True:
+            newline = self._pending.find('\n', start)
+            if newline < 0:
+                break
+            quotes += self._pending.count('"', start, newline)
+            if quotes % 2 == 0:
+                cut = newline
+            start = newline + 1
+        
+        if cut < 0:
+            return []
+        complete, self._pending = self._pending[:cut + 1], self._pending[cut + 1:]
+        return list(csv.reader(io.StringIO(complete)))
+    
+    def close(self) -> List[List[str]]:
+        """Вернуть последнюю запись (файл может не заканчиваться переводом строки)"""
+        self._pending += self._decoder.decode(b'', final=True)
+        complete, self._pending = self._pending, ''
+        return list(csv.reader(io.StringIO(complete))) if complete else []
+
+def new_catalog_builder() -> Dict:
+    """Состояние сборки справочника из потока записей CSV"""
+    return {'build_row': None, 'data': [], 'index': None}
+
+def add_csv_records_to_catalog(catalog: Dict, records: List[List[str]]):
+    """Превратить записи в строки справочника и сразу добавить их в индекс поиска ТП"""
+    data = catalog['data']
+    for values in records:
+        # Пустые строки пропускаем, как csv.DictReader
+        if not values:
+            continue
+        
+        # Первая запись - заголовок
+        if catalog['build_row'] is None:
+            catalog['build_row'] = make_catalog_row_builder(values)
+            if 'Наименование ТП' in (name.strip() for name in values):
+                catalog['index'] = new_tp_search_index(data)
+            continue
+        
+        row = catalog['build_row'](values)
+        data.append(row)
+        if catalog['index'] is not None:
+            add_row_to_tp_search_index(catalog['index'], len(data) - 1, row)
+
+def finish_catalog(catalog: Dict) -> Tuple[Tuple[CatalogRow, ...], Optional[Dict]]:
+    """Строки справочника и готовый индекс (None, если в файле нет колонки ТП или строк)
+    
+    Строки отдаются кортежами - после публикации в кэше справочник не меняется."""
+    data = tuple(catalog['data'])
+    index = catalog['index']
+    if index is not None and data:
+        finalize_tp_search_index(index)
+        index['data'] = data
+    else:
+        index = None
+    return data, index
+
+def feed_csv_chunk(parser: CsvStreamParser, catalog: Dict, chunk: bytes):
+    """Разобрать очередной кусок CSV в справочник (выполняется в пуле разбора)"""
+    add_csv_records_to_catalog(catalog, parser.feed(chunk))
+
+def close_csv_catalog(parser: CsvStreamParser, catalog: Dict) -> Tuple[Tuple[CatalogRow, ...], Optional[Dict], int]:
+    """Дочитать последний кусок и достроить индекс: (строки, индекс, оценка памяти)"""
+    add_csv_records_to_catalog(catalog, parser.close())
+    data, index = finish_catalog(catalog)
+    return data, index, estimate_catalog_size(data, index)
+
+def build_catalog_from_chunks(chunks: List[bytes]) -> Tuple[Tuple[CatalogRow, ...], Optional[Dict], int]:
+    """Разобрать CSV из кусков целиком (в пуле потоков или в отдельном процессе)"""
+    parser = CsvStreamParser()
+    catalog = new_catalog_builder()
+    # Разобранные куски сразу отпускаем
+    chunks.reverse()
+    while chunks:
+        feed_csv_chunk(parser, catalog, chunks.pop())
+    return close_csv_catalog(parser, catalog)
+
 async def load_csv_from_url_async(url: str) -> List[Dict]:
-    """Асинхронная загрузка CSV с кэшированием"""
+    """Асинхронная загрузка CSV с кэшированием (единственный загрузчик справочников)
+    
+    Устаревший кэш отдается сразу, а обновляется в фоне (stale-while-revalidate)."""
     # Проверяем кэш
     if url in csv_cache:
+        csv_cache_last_access[url] = time.monotonic()
         cache_time = csv_cache_time.get(url)
         if cache_time and (datetime.now() - cache_time) < CSV_CACHE_DURATION:
             logger.info(f"✅ Используем кэш для {url} ({len(csv_cache[url])} строк)")
             return csv_cache[url]
+        
+        schedule_csv_refresh(url)
+        logger.info(f"⏳ Используем устаревший кэш для {url}, обновляем в фоне")
+        return csv_cache[url]
     
     try:
-        logger.info(f"📥 Загружаем CSV из {url}")
-        
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, timeout=aiohttp.ClientTimeout(total=10)) as response:
-                response.raise_for_status()
-                text = await response.text()
-                
-                # Обрабатываем CSV
-                csv_file = io.StringIO(text)
-                reader = csv.DictReader(csv_file)
-                
-                data = []
-                for row in reader:
-                    normalized_row = {key.strip(): value.strip() if value else '' for key, value in row.items()}
-                    data.append(normalized_row)
-                
-                # Сохраняем в кэш
-                csv_cache[url] = data
-                csv_cache_time[url] = datetime.now()
-                
-                logger.info(f"✅ Загружено и закэшировано {len(data)} строк")
-                return data
-                
+        data = await fetch_csv_single_flight(url, load_uncached_csv)
+        if url in csv_cache:
+            csv_cache_last_access[url] = time.monotonic()
+        return data
     except asyncio.TimeoutError:
         logger.error(f"⏱️ Таймаут при загрузке CSV из {url}")
-        # Если есть старый кэш - используем его
-        if url in csv_cache:
-            logger.warning("⚠️ Используем устаревший кэш из-за таймаута")
-            return csv_cache[url]
         return []
     except Exception as e:
         logger.error(f"❌ Ошибка загрузки CSV: {e}")
-        if url in csv_cache:
-            return csv_cache[url]
         return []
 
-# Синхронная версия для обратной совместимости
-def load_csv_from_url(url: str) -> List[Dict]:
-    """Загрузить CSV файл по URL (проверяет кэш)"""
-    # Сначала проверяем кэш
-    if url in csv_cache:
-        cache_time = csv_cache_time.get(url)
-        if cache_time and (datetime.now() - cache_time) < CSV_CACHE_DURATION:
-            logger.info(f"✅ Используем кэш для {url} ({len(csv_cache[url])} строк)")
-            return csv_cache[url]
+async def load_uncached_csv(url: str) -> List[Dict]:
+    """Загрузить справочник, которого нет в памяти"""
+    # Вытесненный из памяти справочник быстрее поднять из снимка, чем скачать заново
+    data = await reload_csv_from_snapshot(url)
+    if data is not None:
+        return data
     
-    # Если кэша нет - загружаем синхронно
-    try:
-        logger.info(f"Загружаем CSV из {url}")
-        response = session.get(url, timeout=30)  # Используем session с пулом
-        response.raise_for_status()
-        response.encoding = 'utf-8-sig'
+    logger.info(f"📥 Загружаем CSV из {url}")
+    return await fetch_csv_from_url(url)
+
+def fetch_csv_single_flight(url: str, loader=None) -> asyncio.Future:
+    """Загрузка CSV, общая для всех одновременных вызовов с этим URL
+    
+    loader - корутина загрузки (по умолчанию скачивание); отмена одного ожидающего (shield)
+    не прерывает загрузку для остальных."""
+    key = (url, loader or fetch_csv_from_url)
+    task = csv_fetch_tasks.get(key)
+    if task is None:
+        task = asyncio.get_running_loop().create_task(key[1](url))
+        csv_fetch_tasks[key] = task
+        task.add_done_callback(lambda done: finish_csv_fetch(key, done))
+    else:
+        logger.info(f"⏳ CSV {url} уже загружается, ждем эту загрузку")
+    return asyncio.shield(task)
+
+def finish_csv_fetch(key: Tuple, task: asyncio.Task):
+    """Убрать завершенную загрузку из идущих"""
+    if csv_fetch_tasks.get(key) is task:
+        del csv_fetch_tasks[key]
+    # Ошибку получают ожидающие; если их не осталось - не даем asyncio ругаться на непрочитанную ошибку
+    if not task.cancelled():
+        task.exception()
+
+async def fetch_csv_from_url(url: str) -> List[Dict]:
+    """Скачать CSV (или убедиться, что он не изменился) и обновить кэш; ошибки пробрасываются
+    
+    Справочник, вытесненный из памяти, пока шло его фоновое обновление, обратно в кэш не кладется."""
+    refreshing = url in csv_cache
+    headers = get_revalidation_headers(url)
+    async with get_http_session().get(url, headers=headers, timeout=aiohttp.ClientTimeout(total=10)) as response:
+        # Сервер подтвердил, что файл не изменился - продлеваем кэш
+        if response.status == 304:
+            if url in csv_cache:
+                extend_csv_cache_ttl(url)
+                logger.info(f"♻️ CSV не изменился (304), продлеваем кэш для {url}")
+                return csv_cache[url]
+            # Копию вытеснили, пока шел условный запрос: у 304 нет тела, разбирать и сохранять нечего
+            raise aiohttp.ClientResponseError(
+                response.request_info, response.history, status=304,
+                message='Not Modified, а закэшированной копии уже нет',
+            )
         
-        csv_file = io.StringIO(response.text)
-        reader = csv.DictReader(csv_file)
+        response.raise_for_status()
         
-        data = []
-        for row in reader:
-            normalized_row = {key.strip(): value.strip() if value else '' for key, value in row.items()}
-            data.append(normalized_row)
+        # Google отдает CSV в UTF-8 с BOM - разбираем поток кусками, строки сразу идут в индекс.
+        # Разбор и индекс строятся в пуле, чтобы не задерживать event loop
+        loop = asyncio.get_running_loop()
+        executor = get_csv_parse_executor()
+        digest = hashlib.sha256()
+        parser = CsvStreamParser()
+        catalog = new_catalog_builder()
+        # Закэшированный CSV мог не измениться - тогда разбирать его незачем, поэтому сначала
+        # только копим куски и считаем хэш. В процесс куски передаются все сразу
+        stream_parse = url not in csv_cache and CSV_PARSE_EXECUTOR != 'process'
+        chunks = []
+        async for chunk in response.content.iter_chunked(CSV_STREAM_CHUNK_SIZE):
+            digest.update(chunk)
+            if stream_parse:
+                await loop.run_in_executor(executor, feed_csv_chunk, parser, catalog, chunk)
+            else:
+                chunks.append(chunk)
         
-        # Сохраняем в кэш
-        csv_cache[url] = data
-        csv_cache_time[url] = datetime.now()
+        validators = {
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'sha256': digest.hexdigest(),
+        }
         
-        logger.info(f"Успешно загружено {len(data)} строк из CSV")
-        return data
-    except requests.exceptions.Timeout:
-        logger.error(f"Таймаут при загрузке CSV из {url}")
-        if url in csv_cache:
+        # Google не всегда отдает ETag - сравниваем хэш содержимого
+        if url in csv_cache and csv_cache_meta.get(url, {}).get('sha256') == validators['sha256']:
+            extend_csv_cache_ttl(url, validators)
+            logger.info(f"♻️ Содержимое CSV не изменилось, продлеваем кэш для {url}")
             return csv_cache[url]
-        return []
+        
+        if stream_parse:
+            data, index, size = await loop.run_in_executor(executor, close_csv_catalog, parser, catalog)
+        else:
+            data, index, size = await loop.run_in_executor(executor, build_catalog_from_chunks, chunks)
+        
+        if refreshing and url not in csv_cache:
+            logger.info(f"🧹 CSV {url} вытеснен из памяти во время обновления, в кэш не кладем")
+            return data
+        
+        # Сохраняем в кэш (вместе с индексом поиска)
+        store_csv_in_cache(url, data, validators, index, size)
+        
+        logger.info(f"✅ Загружено и закэшировано {len(data)} строк")
+    
+    # Снимок на диск пишем в потоке, чтобы не задерживать event loop
+    await asyncio.to_thread(save_csv_snapshot, url)
+    return data
+
+# ==================== ПУЛ РАЗБОРА CSV ====================
+
+# Где разбирать CSV и строить индексы: 'thread' - пул потоков (по кускам, пока идет загрузка),
+# 'process' - пул процессов (файл целиком, не занимает GIL основного процесса)
+CSV_PARSE_EXECUTOR = os.environ.get('CSV_PARSE_EXECUTOR', 'thread')
+CSV_PARSE_WORKERS = int(os.environ.get('CSV_PARSE_WORKERS', '2'))
+csv_parse_executor: Optional[Executor] = None
+
+# Порог нулевого поколения сборщика циклов (0 - стандартный). Построение справочника создает
+# сотни тысяч объектов, и со стандартным порогом 700 полные проходы GC по всем загруженным
+# справочникам останавливают event loop на сотни миллисекунд при каждом обновлении
+GC_GEN0_THRESHOLD = int(os.environ.get('GC_GEN0_THRESHOLD', '10000'))
+
+def configure_gc_for_catalogs():
+    """Поднять порог нулевого поколения GC (при запуске бота)"""
+    if GC_GEN0_THRESHOLD > 0:
+        gc.set_threshold(GC_GEN0_THRESHOLD, *gc.get_threshold()[1:])
+        logger.info(f"♻️ Порог GC: {gc.get_threshold()}")
+
+def get_csv_parse_executor() -> Executor:
+    """Пул разбора CSV (создается при первой загрузке)"""
+    global csv_parse_executor
+    if csv_parse_executor is None:
+        if CSV_PARSE_EXECUTOR == 'process':
+            csv_parse_executor = ProcessPoolExecutor(max_workers=CSV_PARSE_WORKERS)
+        else:
+            csv_parse_executor = ThreadPoolExecutor(max_workers=CSV_PARSE_WORKERS, thread_name_prefix='csv-parse')
+        logger.info(f"⚙️ Пул разбора CSV: {CSV_PARSE_EXECUTOR}, {CSV_PARSE_WORKERS} исполнителей")
+    return csv_parse_executor
+
+def shutdown_csv_parse_executor():
+    """Остановить пул разбора CSV (при остановке бота)"""
+    global csv_parse_executor
+    if csv_parse_executor is not None:
+        csv_parse_executor.shutdown(wait=False, cancel_futures=True)
+        csv_parse_executor = None
+
+# ==================== ФОНОВОЕ ОБНОВЛЕНИЕ CSV ====================
+
+def schedule_csv_refresh(url: str):
+    """Запустить фоновое обновление CSV (не чаще одного на URL и не сразу после ошибки)"""
+    task = csv_refresh_tasks.get(url)
+    if task and not task.done():
+        return
+    
+    stats = csv_refresh_stats.get(url)
+    if stats and stats['retry_after'] and datetime.now() < stats['retry_after']:
+        return
+    
+    csv_refresh_tasks[url] = asyncio.get_running_loop().create_task(refresh_csv(url))
+
+async def refresh_csv(url: str):
+    """Обновить CSV в кэше; при ошибке остается старая копия"""
+    stats = csv_refresh_stats.setdefault(url, {
+        'refreshes': 0,
+        'failures': 0,
+        'last_duration': None,
+        'last_refresh': None,
+        'last_error': None,
+        'retry_after': None,
+    })
+    
+    started = time.perf_counter()
+    try:
+        await fetch_csv_single_flight(url)
+        stats['refreshes'] += 1
+        stats['last_refresh'] = datetime.now()
+        stats['last_error'] = None
+        stats['retry_after'] = None
     except Exception as e:
-        logger.error(f"Ошибка загрузки CSV: {e}", exc_info=True)
-        if url in csv_cache:
-            return csv_cache[url]
-        return []
+        stats['failures'] += 1
+        stats['last_error'] = str(e) or type(e).__name__
+        stats['retry_after'] = datetime.now() + CSV_REFRESH_RETRY_DELAY
+        logger.error(f"❌ Ошибка фонового обновления CSV {url}: {stats['last_error']}")
+    finally:
+        stats['last_duration'] = time.perf_counter() - started
+        csv_refresh_tasks.pop(url, None)
+    
+    logger.info(f"🔄 Фоновое обновление CSV {url}: {stats['last_duration']:.2f} с")
+
+async def refresh_csv_cache_periodically():
+    """Заранее обновлять CSV, у которых скоро истекает кэш"""
+    while True:
+        await asyncio.sleep(CSV_REFRESH_CHECK_INTERVAL)
+        now = datetime.now()
+        for url, cache_time in list(csv_cache_time.items()):
+            if now - cache_time >= CSV_CACHE_DURATION - CSV_REFRESH_AHEAD:
+                schedule_csv_refresh(url)
+
+def format_csv_refresh_stats() -> str:
+    """Сводка фоновых обновлений CSV для /status (с ошибками по каждому справочнику)"""
+    if not csv_refresh_stats:
+        return "• Фоновые обновления CSV: еще не было"
+    
+    refreshes = sum(stats['refreshes'] for stats in csv_refresh_stats.values())
+    failures = sum(stats['failures'] for stats in csv_refresh_stats.values())
+    slowest = max(stats['last_duration'] or 0 for stats in csv_refresh_stats.values())
+    lines = [f"• Фоновые обновления CSV: {refreshes} успешно, {failures} ошибок, самое долгое {slowest:.1f} с"]
+    
+    env_keys = {value: key for key, value in os.environ.items()}
+    for url, stats in csv_refresh_stats.items():
+        if stats['last_error']:
+            lines.append(f"  ⚠️ {env_keys.get(url, url)}: {stats['last_error']}")
+    return '\n'.join(lines)
+
+# ==================== СНИМКИ CSV НА ДИСКЕ ====================
+
+# Меняется при изменении формата строк или индекса - старые снимки игнорируются
+CSV_SNAPSHOT_FORMAT = 4
+
+def get_csv_snapshot_path(url: str) -> str:
+    """Файл снимка для URL"""
+    return os.path.join(CSV_SNAPSHOT_DIR, hashlib.sha1(url.encode('utf-8')).hexdigest() + '.pickle')
+
+def save_csv_snapshot(url: str):
+    """Сохранить разобранный CSV, его индекс и валидаторы в снимок"""
+    if not CSV_SNAPSHOT_DIR or url not in csv_cache:
+        return
+    
+    index = csv_index_cache.get(url)
+    snapshot = {
+        'format': CSV_SNAPSHOT_FORMAT,
+        'url': url,
+        'data': csv_cache[url],
+        'index': index,
+        'meta': csv_cache_meta.get(url, {}),
+        'cache_time': csv_cache_time[url],
+    }
+    
+    path = get_csv_snapshot_path(url)
+    temp_file = path + '.tmp'
+    try:
+        os.makedirs(CSV_SNAPSHOT_DIR, exist_ok=True)
+        with open(temp_file, 'wb') as f:
+            pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_file, path)
+        logger.info(f"💾 Снимок CSV сохранен: {url} ({len(snapshot['data'])} строк)")
+    except Exception as e:
+        logger.error(f"❌ Ошибка сохранения снимка CSV {url}: {e}")
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+
+def load_csv_snapshot(path: str) -> Optional[Dict]:
+    """Прочитать снимок (None, если файл поврежден или старого формата)"""
+    try:
+        with open(path, 'rb') as f:
+            snapshot = pickle.load(f)
+    except Exception as e:
+        logger.error(f"❌ Ошибка чтения снимка CSV {path}: {e}")
+        return None
+    
+    if not isinstance(snapshot, dict) or snapshot.get('format') != CSV_SNAPSHOT_FORMAT:
+        logger.warning(f"⚠️ Снимок CSV {path} старого формата, пропускаем")
+        return None
+    
+    # Оценку памяти считаем здесь же, в потоке чтения
+    snapshot['size'] = estimate_catalog_size(snapshot['data'], snapshot['index'])
+    return snapshot
+
+async def restore_csv_snapshots():
+    """Восстановить кэш CSV из снимков и запустить их фоновую проверку актуальности"""
+    if not CSV_SNAPSHOT_DIR or not os.path.isdir(CSV_SNAPSHOT_DIR):
+        return
+    
+    started = time.perf_counter()
+    # Снимки справочников, которых больше нет в настройках, удаляем, а не поднимаем
+    configured_urls = set(get_configured_csv_urls().values())
+    if ZONES_CSV_URL:
+        configured_urls.add(ZONES_CSV_URL)
+    configured_paths = {get_csv_snapshot_path(url) for url in configured_urls}
+    paths = []
+    for name in os.listdir(CSV_SNAPSHOT_DIR):
+        if not name.endswith('.pickle'):
+            continue
+        path = os.path.join(CSV_SNAPSHOT_DIR, name)
+        if path in configured_paths:
+            paths.append(path)
+            continue
+        try:
+            os.remove(path)
+            logger.info(f"🗑️ Удален снимок CSV {path}: справочник больше не настроен")
+        except OSError as e:
+            logger.warning(f"⚠️ Не удалось удалить снимок CSV {path}: {e}")
+    snapshots = await asyncio.gather(*(asyncio.to_thread(load_csv_snapshot, path) for path in paths))
+    
+    restored = 0
+    for snapshot in snapshots:
+        if not snapshot or snapshot['url'] not in configured_urls:
+            continue
+        install_csv_snapshot(snapshot)
+        # Снимок мог устареть, пока бот был остановлен - проверяем условным запросом
+        schedule_csv_refresh(snapshot['url'])
+        restored += 1
+    
+    logger.info(f"💾 Восстановлено из снимков {restored} CSV за {time.perf_counter() - started:.2f} с")
+
+def install_csv_snapshot(snapshot: Dict):
+    """Положить справочник из снимка в кэш (вместе с индексом и валидаторами)"""
+    url = snapshot['url']
+    index = snapshot['index']
+    if index:
+        csv_index_cache[url] = index
+    else:
+        csv_index_cache.pop(url, None)
+    csv_cache[url] = snapshot['data']
+    csv_cache_time[url] = snapshot['cache_time']
+    csv_cache_meta[url] = snapshot['meta']
+    csv_cache_version[url] = csv_cache_version.get(url, 0) + 1
+    invalidate_search_results_cache(url)
+    
+    csv_cache_size[url] = snapshot['size']
+    enforce_csv_memory_budget(keep_url=url)
+
+async def reload_csv_from_snapshot(url: str) -> Optional[List[Dict]]:
+    """Поднять справочник из снимка (после вытеснения из памяти); None, если снимка нет"""
+    if not CSV_SNAPSHOT_DIR:
+        return None
+    path = get_csv_snapshot_path(url)
+    if not os.path.exists(path):
+        return None
+    
+    snapshot = await asyncio.to_thread(load_csv_snapshot, path)
+    if not snapshot or snapshot['url'] != url:
+        return None
+    
+    install_csv_snapshot(snapshot)
+    logger.info(f"💾 CSV {url} поднят из снимка ({len(snapshot['data'])} строк)")
+    if datetime.now() - snapshot['cache_time'] >= CSV_CACHE_DURATION:
+        schedule_csv_refresh(url)
+    return snapshot['data']
+
+# ==================== БЮДЖЕТ ПАМЯТИ КЭША CSV ====================
+
+def estimate_row_size(row) -> int:
+    """Память строки справочника вместе со значениями (байт)"""
+    if isinstance(row, CatalogRow):
+        return sys.getsizeof(row) + sys.getsizeof(row._values) + sum(sys.getsizeof(value) for value in row._values)
+    return sys.getsizeof(row) + sum(sys.getsizeof(key) + sys.getsizeof(value) for key, value in row.items())
+
+def estimate_index_size(index: Dict) -> int:
+    """Память индекса поиска ТП (байт): контейнеры целиком, записи - по выборке"""
+    entries = index['entries']
+    size = sys.getsizeof(entries)
+    if entries:
+        sample = entries[::max(1, len(entries) // 200)]
+        entry_size = sum(sys.getsizeof(entry) + sum(sys.getsizeof(part) for part in entry) for entry in sample) / len(sample)
+        size += int(entry_size * len(entries))
+    
+    for key in ('entry_ids', 'compact_exact', 'ngrams', 'letter_parts', 'digit_parts', 'res_entries',
+                'rows_by_tp_name', 'rows_by_clean_tp_name', 'vl_by_tp_name'):
+        mapping = index[key]
+        size += sys.getsizeof(mapping) + sum(sys.getsizeof(value) for value in mapping.values())
+    size += sum(sys.getsizeof(rows) for rows in index['entry_rows'])
+    for key in ('digit_keys', 'simplified_offsets', 'simplified_haystack', 'cable_with_station', 'cable_marked_with_station'):
+        if key in index:
+            size += sys.getsizeof(index[key])
+    
+    deletes = index.get('fuzzy_deletes')
+    if deletes:
+        size += sys.getsizeof(deletes) + sum(sys.getsizeof(key) + sys.getsizeof(entry_ids) for key, entry_ids in deletes.items())
+    if index.get('frames'):
+        size += sum(int(frame.memory_usage(deep=True).sum()) for frame in index['frames'].values())
+    return size
+
+def estimate_catalog_size(data: List[Dict], index: Optional[Dict]) -> int:
+    """Оценка памяти справочника (байт): строки по выборке плюс индекс"""
+    size = sys.getsizeof(data)
+    if data:
+        sample = data[::max(1, len(data) // 200)]
+        size += int(sum(estimate_row_size(row) for row in sample) / len(sample) * len(data))
+    if index:
+        size += estimate_index_size(index)
+    return size
+
+def is_csv_cache_entry_pinned(url: str, now: float) -> bool:
+    """Справочник нельзя вытеснять: пользователи или недавно использовался"""
+    return url == ZONES_CSV_URL or now - csv_cache_last_access.get(url, 0) < CSV_CACHE_PIN_SECONDS
+
+def evict_csv_cache_entry(url: str):
+    """Убрать справочник из памяти (снимок на диске остается)"""
+    for cache in (csv_cache, csv_index_cache, csv_cache_time, csv_cache_meta, csv_cache_size, csv_cache_last_access):
+        cache.pop(url, None)
+    invalidate_search_results_cache(url)
+    csv_cache_evictions['count'] += 1
+
+def enforce_csv_memory_budget(keep_url: str = None):
+    """Вытеснять давно не использованные справочники, пока кэш не уложится в бюджет"""
+    if not CSV_CACHE_MEMORY_BUDGET_MB:
+        return
+    budget = CSV_CACHE_MEMORY_BUDGET_MB * 1024 * 1024
+    now = time.monotonic()
+    
+    total = sum(csv_cache_size.values())
+    candidates = sorted(
+        (url for url in csv_cache if url != keep_url and not is_csv_cache_entry_pinned(url, now)),
+        key=lambda url: csv_cache_last_access.get(url, 0),
+    )
+    for url in candidates:
+        if total <= budget:
+            break
+        total -= csv_cache_size.get(url, 0)
+        evict_csv_cache_entry(url)
+        logger.info(f"🧹 CSV {url} вытеснен из памяти (бюджет {CSV_CACHE_MEMORY_BUDGET_MB} МБ)")
+    
+    if total > budget:
+        logger.warning(f"⚠️ Кэш CSV занимает {total / 1024 / 1024:.1f} МБ при бюджете {CSV_CACHE_MEMORY_BUDGET_MB} МБ: остальные справочники используются")
+
+def format_csv_cache_sizes() -> str:
+    """Размеры справочников в памяти для /status (📌 - не вытесняется)"""
+    total = sum(csv_cache_size.values())
+    budget = f"{CSV_CACHE_MEMORY_BUDGET_MB} МБ" if CSV_CACHE_MEMORY_BUDGET_MB else "без ограничения"
+    lines = [f"• Память CSV: {total / 1024 / 1024:.1f} МБ (бюджет {budget}), вытеснено {csv_cache_evictions['count']}"]
+    
+    now = time.monotonic()
+    env_keys = {value: key for key, value in os.environ.items()}
+    for url in sorted(csv_cache_size, key=csv_cache_size.get, reverse=True):
+        pin = ' 📌' if is_csv_cache_entry_pinned(url, now) else ''
+        lines.append(f"  {env_keys.get(url, url)}: {csv_cache_size[url] / 1024 / 1024:.1f} МБ, {len(csv_cache.get(url, []))} строк{pin}")
+    return '\n'.join(lines)
 
 # ==================== ПРЕДЗАГРУЗКА CSV ====================
 
+def get_configured_csv_urls() -> Dict[str, str]:
+    """CSV-справочники из переменных окружения: имя переменной -> URL"""
+    return {
+        key: value for key, value in os.environ.items()
+        if 'URL' in key and value and value.startswith('http') and 'csv' in value.lower()
+    }
+
 async def preload_csv_files():
     """Предзагрузка всех CSV файлов филиалов при старте"""
     logger.info("🚀 Начинаем предзагрузку CSV файлов...")
@@ -515,12 +1768,11 @@ async def preload_csv_files():
     csv_urls = []
     
     # Собираем все URL из переменных окружения
-    for key, value in os.environ.items():
-        if 'URL' in key and value and value.startswith('http') and 'csv' in value.lower():
-            # Исключаем ZONES_CSV_URL так как он загружается отдельно
-            if key != 'ZONES_CSV_URL':
-                csv_urls.append(value)
-                tasks.append(load_csv_from_url_async(value))
+    for key, value in get_configured_csv_urls().items():
+        # Исключаем ZONES_CSV_URL так как он загружается отдельно
+        if key != 'ZONES_CSV_URL':
+            csv_urls.append(value)
+            tasks.append(load_csv_from_url_async(value))
     
     # Загружаем параллельно
     if tasks:
@@ -546,34 +1798,87 @@ def get_moscow_time():
     """Получить текущее время в Москве"""
     return datetime.now(MOSCOW_TZ)
 
-def save_bot_users():
-    """Сохранить данные о пользователях бота в файл"""
+def write_bot_users_file(payload: bytes):
+    """Атомарно записать файл пользователей бота: временный файл, fsync, os.replace"""
+    temp_file = BOT_USERS_FILE + '.tmp'
+    with open(temp_file, 'wb') as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_file, BOT_USERS_FILE)
+    
+    # Фиксируем и само переименование (на Windows каталог не открыть - пропускаем)
     try:
-        serializable_data = {}
-        for uid, data in bot_users.items():
-            serializable_data[uid] = {
-                'first_start': data['first_start'].isoformat() if isinstance(data['first_start'], datetime) else data['first_start'],
-                'last_start': data['last_start'].isoformat() if isinstance(data['last_start'], datetime) else data['last_start'],
-                'username': data.get('username', ''),
-                'first_name': data.get('first_name', '')
-            }
-        
-        # Создаем временный файл для безопасного сохранения
-        temp_file = BOT_USERS_FILE + '.tmp'
-        with open(temp_file, 'w', encoding='utf-8') as f:
-            json.dump(serializable_data, f, ensure_ascii=False, indent=2)
-        
-        # Переименовываем временный файл в основной
-        if os.path.exists(temp_file):
-            if os.path.exists(BOT_USERS_FILE):
-                os.remove(BOT_USERS_FILE)
-            os.rename(temp_file, BOT_USERS_FILE)
+        dir_fd = os.open(os.path.dirname(os.path.abspath(BOT_USERS_FILE)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(dir_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(dir_fd)
+
+def save_bot_users(users: Dict = None, generation: int = None) -> bool:
+    """Сохранить данные о пользователях бота в файл
+    
+    Без аргументов сохраняет текущее состояние синхронно (при остановке бота);
+    фоновая запись передает копию bot_users и номер изменения, на котором она снята.
+    Уже записанное состояние повторно не пишется."""
+    global bot_users_saved_generation, bot_users_saved_payload
+    if users is None:
+        users, generation = dict(bot_users), bot_users_generation
+    
+    with bot_users_save_lock:
+        # Это или более новое состояние уже в файле
+        if generation <= bot_users_saved_generation:
+            return True
+        try:
+            serializable_data = {}
+            for uid, data in users.items():
+                serializable_data[uid] = {
+                    'first_start': data['first_start'].isoformat() if isinstance(data['first_start'], datetime) else data['first_start'],
+                    'last_start': data['last_start'].isoformat() if isinstance(data['last_start'], datetime) else data['last_start'],
+                    'username': data.get('username', ''),
+                    'first_name': data.get('first_name', '')
+                }
+            payload = json.dumps(serializable_data, ensure_ascii=False).encode('utf-8')
             
-        logger.info(f"✅ Сохранено {len(bot_users)} пользователей бота в {BOT_USERS_FILE}")
-        return True
-    except Exception as e:
-        logger.error(f"❌ Ошибка сохранения данных пользователей бота: {e}")
-        return False
+            if payload == bot_users_saved_payload:
+                logger.debug("Данные пользователей бота не изменились, запись пропущена")
+            else:
+                write_bot_users_file(payload)
+                logger.info(f"✅ Сохранено {len(users)} пользователей бота в {BOT_USERS_FILE}")
+            
+            bot_users_saved_payload = payload
+            bot_users_saved_generation = generation
+            return True
+        except Exception as e:
+            logger.error(f"❌ Ошибка сохранения данных пользователей бота: {e}")
+            return False
+
+async def save_bot_users_async() -> bool:
+    """Сохранить bot_users в фоновом потоке (копия снимается здесь, в event loop)"""
+    return await asyncio.to_thread(save_bot_users, dict(bot_users), bot_users_generation)
+
+def mark_bot_users_changed():
+    """Отметить изменение bot_users; файл запишется через BOT_USERS_SAVE_DELAY секунд"""
+    global bot_users_generation, bot_users_save_task
+    bot_users_generation += 1
+    if bot_users_save_task is None or bot_users_save_task.done():
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        bot_users_save_task = loop.create_task(save_bot_users_later())
+
+async def save_bot_users_later():
+    """Отложенная запись bot_users: все изменения за время ожидания попадают в одну запись"""
+    while bot_users_generation > bot_users_saved_generation:
+        await asyncio.sleep(BOT_USERS_SAVE_DELAY)
+        if not await save_bot_users_async():
+            # Повторит периодическое автосохранение
+            break
 
 def load_bot_users():
     """Загрузить данные о пользователях бота из файла"""
@@ -622,11 +1927,10 @@ def update_user_activity(user_id: str):
 async def download_document(url: str) -> Optional[BytesIO]:
     """Скачать документ по URL (асинхронно)"""
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, timeout=aiohttp.ClientTimeout(total=15)) as response:
-                if response.status == 200:
-                    content = await response.read()
-                    return BytesIO(content)
+        async with get_http_session().get(url, timeout=aiohttp.ClientTimeout(total=15)) as response:
+            if response.status == 200:
+                content = await response.read()
+                return BytesIO(content)
     except Exception as e:
         logger.error(f"Ошибка загрузки документа: {e}")
     return None
@@ -670,94 +1974,174 @@ async def get_cached_document(doc_name: str, doc_url: str) -> Optional[BytesIO]:
 
 # ==================== ЗАГРУЗКА ДАННЫХ ПОЛЬЗОВАТЕЛЕЙ ====================
 
-def load_users_data():
-    """Загрузить данные пользователей из CSV"""
-    global users_cache, users_cache_backup
+def normalize_responsible_key(value: str) -> str:
+    """Ключ зоны ответственности: без лишних пробелов, регистра и суффикса ЭС"""
+    key = ' '.join((value or '').split()).casefold()
+    if key.endswith(' эс'):
+        key = key[:-3].rstrip()
+    return key
+
+def build_responsible_index(users: Mapping[str, Mapping]) -> Mapping[str, Tuple[str, ...]]:
+    """Индекс ответственных по нормализованной зоне ответственности"""
+    index = {}
+    for uid, udata in users.items():
+        key = normalize_responsible_key(udata.get('responsible', ''))
+        if key:
+            index.setdefault(key, []).append(uid)
+    return MappingProxyType({key: tuple(uids) for key, uids in index.items()})
+
+def find_responsible_users(*zones: str) -> List[str]:
+    """Telegram ID ответственных за любую из зон (филиал, РЭС) без повторов"""
+    by_responsible = users_snapshot.by_responsible
+    found = []
+    for zone in zones:
+        key = normalize_responsible_key(zone)
+        if not key:
+            continue
+        for uid in by_responsible.get(key, ()):
+            if uid not in found:
+                found.append(uid)
+    return found
+
+def build_users_snapshot(data: List[Dict], version: int, source_version: int = 0) -> UsersSnapshot:
+    """Собрать снимок справочника пользователей из строк CSV (выполняется вне event loop)"""
+    users = {}
+    for row in data:
+        telegram_id = row.get('Telegram ID', '').strip()
+        if telegram_id:
+            name_parts = []
+            fio = row.get('ФИО', '').strip()
+            
+            if 'Фамилия' in row:
+                surname = row.get('Фамилия', '').strip()
+            else:
+                surname = ''
+                if telegram_id in ['248207151', '1409325335']:
+                    logger.warning("Колонка 'Фамилия' отсутствует в CSV файле")
+            
+            if fio:
+                name_parts.append(fio)
+            if surname:
+                name_parts.append(surname)
+            
+            full_name = ' '.join(name_parts) if name_parts else 'Неизвестный'
+            
+            users[telegram_id] = MappingProxyType({
+                'visibility': row.get('Видимость', '').strip(),
+                'branch': row.get('Филиал', '').strip(),
+                'res': row.get('РЭС', '').strip(),
+                'name': full_name,
+                'name_without_surname': fio if fio else 'Неизвестный',
+                'responsible': row.get('Ответственный', '').strip(),
+                'email': row.get('Email', '').strip()
+            })
+    
+    users = MappingProxyType(users)
+    return UsersSnapshot(version, users, build_responsible_index(users), source_version)
+
+async def load_users_data():
+    """Загрузить данные пользователей из CSV
+    
+    Новый снимок собирается в отдельном потоке и подменяет старый одним присваиванием;
+    если загрузка не удалась, продолжаем работать со старым снимком."""
+    global users_snapshot
     try:
         if not ZONES_CSV_URL:
             logger.error("ZONES_CSV_URL не задан в переменных окружения!")
             return
             
         logger.info(f"Начинаем загрузку данных из {ZONES_CSV_URL}")
-        data = load_csv_from_url(ZONES_CSV_URL)
+        data = await load_csv_from_url_async(ZONES_CSV_URL)
         
         if not data:
             logger.error("Получен пустой список данных из CSV")
-            if users_cache_backup:
-                logger.warning("Используем резервную копию данных пользователей")
-                users_cache = users_cache_backup.copy()
+            if users_snapshot.users:
+                logger.warning(f"Оставляем текущие данные пользователей (версия {users_snapshot.version})")
             return
-            
-        if users_cache:
-            users_cache_backup = users_cache.copy()
-            
-        users_cache = {}
         
-        if data:
-            logger.info(f"Структура CSV (первая строка): {list(data[0].keys())}")
+        # Справочник в кэше не менялся с прошлой сборки - снимок остается прежним
+        source_version = csv_cache_version.get(ZONES_CSV_URL, 0)
+        if users_snapshot.users and users_snapshot.source_version == source_version:
+            logger.info(f"Данные пользователей не изменились (версия {users_snapshot.version})")
+            return
         
-        for row in data:
-            telegram_id = row.get('Telegram ID', '').strip()
-            if telegram_id:
-                name_parts = []
-                fio = row.get('ФИО', '').strip()
-                
-                if 'Фамилия' in row:
-                    surname = row.get('Фамилия', '').strip()
-                else:
-                    surname = ''
-                    if telegram_id in ['248207151', '1409325335']:
-                        logger.warning("Колонка 'Фамилия' отсутствует в CSV файле")
-                
-                if fio:
-                    name_parts.append(fio)
-                if surname:
-                    name_parts.append(surname)
-                
-                full_name = ' '.join(name_parts) if name_parts else 'Неизвестный'
-                
-                users_cache[telegram_id] = {
-                    'visibility': row.get('Видимость', '').strip(),
-                    'branch': row.get('Филиал', '').strip(),
-                    'res': row.get('РЭС', '').strip(),
-                    'name': full_name,
-                    'name_without_surname': fio if fio else 'Неизвестный',
-                    'responsible': row.get('Ответственный', '').strip(),
-                    'email': row.get('Email', '').strip()
-                }
+        logger.info(f"Структура CSV (первая строка): {list(data[0].keys())}")
+        snapshot = await asyncio.to_thread(build_users_snapshot, data, users_snapshot.version + 1, source_version)
         
-        if users_cache:
-            users_cache_backup = users_cache.copy()
-            
-        logger.info(f"Загружено {len(users_cache)} пользователей")
+        if not snapshot.users:
+            logger.error("В CSV нет ни одного пользователя с Telegram ID, оставляем текущие данные")
+            return
+        
+        users_snapshot = snapshot
+        logger.info(f"Загружено {len(snapshot.users)} пользователей (версия {snapshot.version}), зон ответственности: {len(snapshot.by_responsible)}")
         
-        if users_cache:
-            sample_users = list(users_cache.items())[:3]
-            for uid, udata in sample_users:
-                logger.info(f"Пример пользователя: ID={uid}, visibility={udata.get('visibility')}, name={udata.get('name')}")
+        sample_users = list(snapshot.users.items())[:3]
+        for uid, udata in sample_users:
+            logger.info(f"Пример пользователя: ID={uid}, visibility={udata.get('visibility')}, name={udata.get('name')}")
                 
     except Exception as e:
         logger.error(f"Ошибка загрузки данных пользователей: {e}", exc_info=True)
-        if users_cache_backup:
-            logger.warning("Восстанавливаем данные из резервной копии после ошибки")
-            users_cache = users_cache_backup.copy()
-
-def get_user_permissions(user_id: str) -> Dict:
-    """Получить права пользователя"""
-    if not users_cache:
-        logger.warning(f"users_cache пустой при запросе прав для пользователя {user_id}, пытаемся загрузить")
-        load_users_data()
-    
-    user_data = users_cache.get(str(user_id), {
-        'visibility': None,
-        'branch': None,
-        'res': None,
-        'name': 'Неизвестный',
-        'name_without_surname': 'Неизвестный',
-        'responsible': None
-    })
+        if users_snapshot.users:
+            logger.warning(f"Оставляем текущие данные пользователей (версия {users_snapshot.version})")
+
+async def refresh_users_data_if_changed() -> bool:
+    """Проверить справочник пользователей условным запросом и пересобрать, если он изменился
     
-    logger.info(f"Права пользователя {user_id}: visibility={user_data.get('visibility')}, branch={user_data.get('branch')}")
+    Неизменившийся CSV стоит одного запроса с ETag/Last-Modified (или сверки хэша) без пересборки."""
+    if not ZONES_CSV_URL:
+        return False
+    version = users_snapshot.version
+    await fetch_csv_single_flight(ZONES_CSV_URL)
+    await load_users_data()
+    return users_snapshot.version != version
+
+def request_users_reload() -> asyncio.Future:
+    """Попросить фоновую задачу проверить справочник пользователей сейчас, не дожидаясь интервала
+    
+    Future завершается после проверки: True - справочник изменился и пересобран."""
+    future = asyncio.get_running_loop().create_future()
+    users_reload_waiters.append(future)
+    users_reload_event.set()
+    return future
+
+def schedule_users_data_load():
+    """Запустить загрузку пользователей в фоне (если она еще не идет)"""
+    global users_load_task
+    if users_load_task and not users_load_task.done():
+        return
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return
+    users_load_task = loop.create_task(load_users_data())
+
+# Права неизвестного пользователя - одна общая неизменяемая запись
+DEFAULT_USER_PERMISSIONS = MappingProxyType({
+    'visibility': None,
+    'branch': None,
+    'res': None,
+    'name': 'Неизвестный',
+    'name_without_surname': 'Неизвестный',
+    'responsible': None
+})
+# В отладочный лог попадает каждый N-й запрос прав
+PERMISSIONS_LOG_SAMPLE_RATE = int(os.environ.get('PERMISSIONS_LOG_SAMPLE_RATE', '100'))
+permissions_lookups = 0
+
+def get_user_permissions(user_id: str) -> Mapping:
+    """Получить права пользователя (неизменяемая запись из снимка справочника)"""
+    global permissions_lookups
+    users = users_snapshot.users
+    if not users:
+        # Не блокируем обработчик загрузкой - пока данных нет, пользователь получает права по умолчанию
+        logger.warning(f"Справочник пользователей пуст при запросе прав для пользователя {user_id}, запускаем фоновую загрузку")
+        schedule_users_data_load()
+    
+    user_data = users.get(str(user_id), DEFAULT_USER_PERMISSIONS)
+    
+    permissions_lookups += 1
+    if permissions_lookups % PERMISSIONS_LOG_SAMPLE_RATE == 0 and logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Права пользователя {user_id}: visibility={user_data.get('visibility')}, branch={user_data.get('branch')} (запрос прав №{permissions_lookups})")
     
     return user_data
 
@@ -865,7 +2249,7 @@ def get_env_key_for_branch(branch: str, network: str, is_reference: bool = False
 
 # ==================== ФУНКЦИИ ТЕЛЕФОННОГО СПРАВОЧНИКА ====================
 
-def load_contractors_data() -> List[Dict]:
+async def load_contractors_data() -> List[Dict]:
     """Загрузить данные контрагентов из CSV"""
     contractors_url = os.environ.get('CONTRACTORS_PHONE_BOOK_URL')
     if not contractors_url:
@@ -873,7 +2257,7 @@ def load_contractors_data() -> List[Dict]:
         return []
     
     try:
-        data = load_csv_from_url(contractors_url)
+        data = await load_csv_from_url_async(contractors_url)
         logger.info(f"Загружено {len(data)} контрагентов из справочника")
         return data
     except Exception as e:
@@ -1205,34 +2589,42 @@ def get_report_action_keyboard() -> ReplyKeyboardMarkup:
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
 
 # ВАЖНАЯ ФУНКЦИЯ! Клавиатура для двойного поиска - показывает ВСЕ найденные ТП
-def get_dual_search_keyboard(registry_tp_names: List[str], structure_tp_names: List[str]) -> ReplyKeyboardMarkup:
+def get_dual_search_keyboard(registry_tp_names: List[str], structure_tp_names: List[str],
+                             registry_total: Tuple[int, bool] = None, structure_total: Tuple[int, bool] = None) -> ReplyKeyboardMarkup:
     """Клавиатура с результатами поиска из двух справочников
-    ВАЖНО: Показывает найденные ТП с учетом ограничения на количество"""
+    ВАЖНО: Показывает найденные ТП с учетом ограничения на количество
+    
+    registry_total/structure_total - (найдено ТП, число точное), если названий найдено больше, чем передано"""
     keyboard = []
     
     # Ограничиваем количество отображаемых ТП (учитываем навигационную строку)
-    max_items_per_column = (MAX_BUTTONS_BEFORE_BACK - 2) // 2  # -2 для навигации, делим на 2 колонки
-    
-    # Если слишком много результатов - обрезаем и информируем
-    registry_truncated = len(registry_tp_names) > max_items_per_column
-    structure_truncated = len(structure_tp_names) > max_items_per_column
+    max_items_per_column = DUAL_SEARCH_TOP_K  # -2 для навигации, делим на 2 колонки
     
     registry_tp_display = registry_tp_names[:max_items_per_column]
     structure_tp_display = structure_tp_names[:max_items_per_column]
     
+    if registry_total is None:
+        registry_total = (len(registry_tp_names), True)
+    if structure_total is None:
+        structure_total = (len(structure_tp_names), True)
+    
+    # Если слишком много результатов - обрезаем и информируем
+    registry_truncated = registry_total != (len(registry_tp_display), True)
+    structure_truncated = structure_total != (len(structure_tp_display), True)
+    
     # Определяем максимальное количество строк
     max_rows = max(len(registry_tp_display), len(structure_tp_display), 1)
     
-    logger.info(f"[get_dual_search_keyboard] Реестр ТП: {len(registry_tp_names)} (показано: {len(registry_tp_display)}), Структура ТП: {len(structure_tp_names)} (показано: {len(structure_tp_display)})")
+    logger.info(f"[get_dual_search_keyboard] Реестр ТП: {format_found_count(registry_total)} (показано: {len(registry_tp_display)}), Структура ТП: {format_found_count(structure_total)} (показано: {len(structure_tp_display)})")
     
     # Всегда добавляем заголовок с двумя колонками
     header_left = '📋 РЕЕСТР ДОГОВОРОВ'
     header_right = '🗂️ СТРУКТУРА СЕТИ'
     
     if registry_truncated:
-        header_left += f' ({len(registry_tp_display)} из {len(registry_tp_names)})'
+        header_left += f' ({len(registry_tp_display)} из {format_found_count(registry_total)})'
     if structure_truncated:
-        header_right += f' ({len(structure_tp_display)} из {len(structure_tp_names)})'
+        header_right += f' ({len(structure_tp_display)} из {format_found_count(structure_total)})'
         
     keyboard.append([header_left, header_right])
     
@@ -1275,19 +2667,23 @@ def get_dual_search_keyboard(registry_tp_names: List[str], structure_tp_names: L
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
 
 # ВАЖНАЯ ФУНКЦИЯ! Клавиатура для выбора ТП при уведомлении
-def get_tp_selection_keyboard(tp_list: List[str]) -> ReplyKeyboardMarkup:
-    """Клавиатура для выбора ТП с ограничением количества"""
+def get_tp_selection_keyboard(tp_list: List[str], tp_total: Tuple[int, bool] = None) -> ReplyKeyboardMarkup:
+    """Клавиатура для выбора ТП с ограничением количества
+    
+    tp_total - (найдено ТП, число точное), если названий найдено больше, чем передано"""
     keyboard = []
     
     # Ограничиваем количество ТП (учитываем навигационную строку)
-    tp_truncated = len(tp_list) > MAX_BUTTONS_BEFORE_BACK - 1  # -1 для навигации
-    tp_display = tp_list[:MAX_BUTTONS_BEFORE_BACK - 1]
+    tp_display = tp_list[:TP_SELECTION_TOP_K]  # -1 для навигации
+    if tp_total is None:
+        tp_total = (len(tp_list), True)
+    tp_truncated = tp_total != (len(tp_display), True)
     
-    logger.info(f"[get_tp_selection_keyboard] Создаю клавиатуру для {len(tp_list)} ТП (показано: {len(tp_display)})")
+    logger.info(f"[get_tp_selection_keyboard] Создаю клавиатуру для {format_found_count(tp_total)} ТП (показано: {len(tp_display)})")
     
     # Если обрезали - добавляем информацию
     if tp_truncated:
-        keyboard.append([f'⚠️ Показано {len(tp_display)} из {len(tp_list)} ТП'])
+        keyboard.append([f'⚠️ Показано {len(tp_display)} из {format_found_count(tp_total)} ТП'])
     
     # Добавляем ТП как кнопки
     for tp in tp_display:
@@ -1515,7 +2911,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
     
     logger.info(f"Команда /start от пользователя {user_id} ({update.effective_user.first_name})")
-    logger.info(f"Размер users_cache: {len(users_cache)}")
+    logger.info(f"Пользователей в справочнике: {len(users_snapshot.users)} (версия {users_snapshot.version})")
     
     current_time = get_moscow_time()
     is_new_user = user_id not in bot_users
@@ -1532,11 +2928,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         bot_users[user_id]['last_start'] = current_time
         logger.info(f"🔄 Обновлен последний запуск для: {user_id}")
     
-    # ВАЖНО: Сохраняем немедленно после обновления
-    if save_bot_users():
-        logger.info(f"✅ Данные пользователей сохранены немедленно (всего: {len(bot_users)})")
-    else:
-        logger.error("❌ Не удалось сохранить данные пользователей немедленно")
+    # Файл запишется в фоне через несколько секунд (вместе с другими изменениями)
+    mark_bot_users_changed()
     
     permissions = get_user_permissions(user_id)
     
@@ -1574,8 +2967,8 @@ async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 👤 Ваш ID: {user_id}
 📋 Ваши права: {permissions.get('visibility', 'Нет')}
-👥 Загружено пользователей: {len(users_cache)}
-💾 Резервная копия: {len(users_cache_backup)} пользователей
+👥 Загружено пользователей: {len(users_snapshot.users)}
+🔢 Версия справочника пользователей: {users_snapshot.version}
 🟢 Активировали бота (текущая сессия): {len(bot_users)} пользователей
 🕐 Время сервера: {get_moscow_time().strftime('%d.%m.%Y %H:%M:%S')} МСК
 
@@ -1584,6 +2977,11 @@ async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
 • Уведомлений ЮГ: {len(notifications_storage.get('UG', []))}
 • Активных пользователей: {len(user_activity)}
 • CSV в кэше: {len(csv_cache)} файлов
+• Кэш поиска ТП: {len(search_results_cache)}/{SEARCH_RESULTS_CACHE_SIZE}, попаданий {search_cache_stats['hits']}, промахов {search_cache_stats['misses']}
+• Движок поиска ТП: {TP_SEARCH_ENGINE}
+• Разбор CSV: {CSV_PARSE_EXECUTOR}, {CSV_PARSE_WORKERS} исполнителей
+{format_csv_refresh_stats()}
+{format_csv_cache_sizes()}
 
 🔧 Переменные окружения:
 • BOT_TOKEN: {'✅ Задан' if BOT_TOKEN else '❌ Не задан'}
@@ -1607,19 +3005,19 @@ async def reload_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
     loading_msg = await update.message.reply_text("🔄 Перезагружаю данные пользователей...")
     
     try:
-        global users_cache, users_cache_backup
-        old_count = len(users_cache)
-        users_cache = {}
+        old_count = len(users_snapshot.users)
         
-        load_users_data()
+        # Проверку делает фоновая задача; пока она идет, обработчики работают со старым снимком
+        changed = await asyncio.wait_for(request_users_reload(), timeout=60)
         
-        new_count = len(users_cache)
+        new_count = len(users_snapshot.users)
         
         await loading_msg.edit_text(
             f"✅ Данные успешно перезагружены!\n"
+            f"{'Справочник изменился' if changed else 'Справочник не изменился'}\n"
             f"Было пользователей: {old_count}\n"
             f"Загружено пользователей: {new_count}\n"
-            f"Резервная копия: {len(users_cache_backup)} пользователей\n"
+            f"Версия справочника: {users_snapshot.version}\n"
             f"Активировали бота (текущая сессия): {len(bot_users)} пользователей"
         )
     except Exception as e:
@@ -1655,13 +3053,13 @@ async def check_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # ЧАСТЬ 5.1 КОНЕЦ =====================================================================================================
 # =ЧАСТЬ 5.2 ====== ОТПРАВКА УВЕДОМЛЕНИЙ ====================================================================================
 
-async def send_notification(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Отправить уведомление ответственным лицам"""
+async def send_notification(update: Update, context: ContextTypes.DEFAULT_TYPE, sender_info: Mapping):
+    """Отправить уведомление ответственным лицам
+    
+    sender_info - права отправителя, уже определенные обработчиком сообщения"""
     user_id = str(update.effective_user.id)
     user_data = user_states.get(user_id, {})
     
-    sender_info = get_user_permissions(user_id)
-    
     tp_data = user_data.get('tp_data', {})
     selected_tp = user_data.get('selected_tp')
     selected_vl = user_data.get('selected_vl')
@@ -1681,8 +3079,7 @@ async def send_notification(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Если branch не найден в состоянии, берем из прав пользователя
     if not branch:
-        sender_permissions = get_user_permissions(user_id)
-        branch = sender_permissions.get('branch')
+        branch = sender_info.get('branch')
         logger.warning(f"Branch не найден в состоянии, используем из прав пользователя: {branch}")
     
     # Если network не найден, определяем по branch
@@ -1716,20 +3113,15 @@ async def send_notification(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info(f"  Филиал из справочника: '{branch_from_reference}'")
     logger.info(f"  РЭС из справочника: '{res_from_reference}'")
     
-    for uid, udata in users_cache.items():
-        responsible_for = udata.get('responsible', '').strip()
-        
-        if not responsible_for:
-            continue
-            
-        if responsible_for == branch_from_reference or responsible_for == res_from_reference:
-            responsible_users.append({
-                'id': uid,
-                'name': udata.get('name', 'Неизвестный'),
-                'email': udata.get('email', ''),
-                'responsible_for': responsible_for
-            })
-            logger.info(f"Найден ответственный: {udata.get('name')} (ID: {uid}) - отвечает за '{responsible_for}'")
+    for uid in find_responsible_users(branch_from_reference, res_from_reference):
+        udata = users_snapshot.users.get(uid, {})
+        responsible_users.append({
+            'id': uid,
+            'name': udata.get('name', 'Неизвестный'),
+            'email': udata.get('email', ''),
+            'responsible_for': udata.get('responsible', '')
+        })
+    logger.info(f"Найдено ответственных: {len(responsible_users)} ({', '.join(u['name'] for u in responsible_users)})")
     
     moscow_time = get_moscow_time()
     notification_text = f"""🚨 НОВОЕ УВЕДОМЛЕНИЕ О БЕЗДОГОВОРНОМ ВОЛС
@@ -1877,7 +3269,7 @@ async def send_notification(update: Update, context: ContextTypes.DEFAULT_TYPE):
 Отладочная информация:
 - Филиал из справочника: "{branch_from_reference}"
 - РЭС из справочника: "{res_from_reference}"
-- Всего пользователей в базе: {len(users_cache)}"""
+- Всего пользователей в базе: {len(users_snapshot.users)}"""
     
     # Очищаем временные данные уведомления
     user_states[user_id]['location'] = None
@@ -1893,24 +3285,19 @@ async def send_notification(update: Update, context: ContextTypes.DEFAULT_TYPE):
     csv_url = os.environ.get(env_key)
     
     if csv_url:
-        data = load_csv_from_url(csv_url)
-        # ВАЖНО: используем ТОЧНОЕ название ТП для поиска
-        results = [r for r in data if r.get('Наименование ТП', '') == selected_tp]
+        await load_csv_from_url_async(csv_url)
         
-        logger.info(f"[send_notification] Перезагрузка данных для ТП '{selected_tp}'")
-        logger.info(f"[send_notification] Найдено записей с точным совпадением: {len(results)}")
+        # ВАЖНО: используем ТОЧНОЕ название ТП для поиска (индекс по названию)
+        # и фильтруем по РЭС если нужно
+        user_res = sender_info.get('res')
+        results = get_tp_rows_from_catalog(csv_url, selected_tp, user_res)
         
-        # Фильтруем по РЭС если нужно
-        user_permissions = get_user_permissions(user_id)
-        user_res = user_permissions.get('res')
-        if user_res and user_res != 'All':
-            results = [r for r in results if r.get('РЭС', '').strip() == user_res]
-            logger.info(f"[send_notification] После фильтрации по РЭС '{user_res}': {len(results)} записей")
+        logger.info(f"[send_notification] Перезагрузка данных для ТП '{selected_tp}'")
+        logger.info(f"[send_notification] Найдено записей с точным совпадением (РЭС: {user_res}): {len(results)}")
         
         if results:
             # ВАЖНО: Получаем ВСЕ уникальные ВЛ
-            vl_list = list(set([r['Наименование ВЛ'] for r in results]))
-            vl_list.sort()
+            vl_list = get_vl_list_from_catalog(csv_url, selected_tp, user_res)
             
             logger.info(f"[send_notification] После отправки найдено {len(vl_list)} уникальных ВЛ")
             logger.info(f"[send_notification] ВЛ: {vl_list}")
@@ -2040,6 +3427,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик текстовых сообщений"""
     user_id = str(update.effective_user.id)
     text = update.message.text
+    # Права определяются один раз на сообщение и дальше используются всеми ветками
     permissions = get_user_permissions(user_id)
     
     if not permissions['visibility']:
@@ -2085,8 +3473,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 'first_name': update.effective_user.first_name or ''
             }
         
-        # Сохраняем данные
-        save_bot_users()
+        # Сохраняем данные (в фоне)
+        mark_bot_users_changed()
         
         # Показываем приветствие как при /start
         welcome_text = f"🔄 Перезапуск выполнен!\n\n"
@@ -2129,7 +3517,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 if '📨' in text:
                     recipients_info = f"\n\n⚠️ Внимание: будут уведомлены только те, кто запускал бота после последнего обновления ({len(bot_users)} пользователей)"
                 else:
-                    recipients_info = f"\n\n📋 Будут уведомлены все пользователи из базы данных ({len(users_cache)} пользователей)"
+                    recipients_info = f"\n\n📋 Будут уведомлены все пользователи из базы данных ({len(users_snapshot.users)} пользователей)"
                 
                 await update.message.reply_text(
                     "📢 Введите сообщение для массовой рассылки.\n\n"
@@ -2212,7 +3600,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 logger.info(f"Branch: {branch}, Network: {network}")
                 
                 # Проверяем права пользователя
-                user_permissions = get_user_permissions(user_id)
+                user_permissions = permissions
                 user_branch = user_permissions.get('branch')
                 
                 if user_branch and user_branch != 'All':
@@ -2229,14 +3617,11 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 
                 loading_msg = await update.message.reply_text("🔍 Ищу в справочнике структуры сети...")
                 
-                data = load_csv_from_url(csv_url)
-                results = search_tp_in_data(search_query, data, 'Наименование ТП')
-                
-                # Фильтруем по РЭС если у пользователя ограничения
+                data = await load_csv_from_url_async(csv_url)
+                # Ищем только в разделе РЭС, если у пользователя ограничения
                 user_res = user_permissions.get('res')
-                
-                if user_res and user_res != 'All':
-                    results = [r for r in results if r.get('РЭС', '').strip() == user_res]
+                ranked = await asyncio.to_thread(search_tp_ranked, search_query, data, 'Наименование ТП', user_res, TP_SELECTION_TOP_K)
+                results = ranked['rows']
                 
                 await loading_msg.delete()
                 
@@ -2244,10 +3629,11 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     await update.message.reply_text("❌ ТП не найдена в справочнике структуры сети")
                     return
                 
-                # ВАЖНО: Получаем ВСЕ уникальные ТП
-                tp_list = list(set([r['Наименование ТП'] for r in results]))
+                # ВАЖНО: Получаем лучшие по релевантности уникальные ТП
+                tp_list = ranked['names']
+                tp_total = (ranked['total'], ranked['exact'])
                 
-                logger.info(f"[handle_message] Найдено {len(tp_list)} уникальных ТП для уведомления")
+                logger.info(f"[handle_message] Найдено {format_found_count(tp_total)} уникальных ТП для уведомления")
                 
                 if len(tp_list) == 1:
                     # Даже если найдена одна ТП - показываем список для выбора
@@ -2270,10 +3656,10 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     user_states[user_id]['state'] = 'send_notification'
                     
                     # Используем функцию для создания клавиатуры
-                    reply_markup = get_tp_selection_keyboard(tp_list)
+                    reply_markup = get_tp_selection_keyboard(tp_list, tp_total)
                     
                     await update.message.reply_text(
-                        f"✅ Найдено {len(tp_list)} ТП в структуре сети. Выберите нужную:",
+                        f"✅ Найдено {format_found_count(tp_total)} ТП в структуре сети. Выберите нужную:",
                         reply_markup=reply_markup
                     )
             else:
@@ -2290,12 +3676,12 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 message = f"🔍 Результаты поиска по запросу: **{search_query}**\n\n"
                 
                 if registry_tp_names:
-                    message += f"📋 **Реестр договоров** (найдено {len(dual_results['registry'])} записей)\n"
-                    message += f"   ТП: {len(registry_tp_names)} шт.\n\n"
+                    message += f"📋 **Реестр договоров**\n"
+                    message += f"   ТП: {format_found_count(dual_results['registry_tp_total'])} шт.\n\n"
                 
                 if structure_tp_names:
-                    message += f"🗂️ **Структура сети** (найдено {len(dual_results['structure'])} записей)\n"
-                    message += f"   ТП: {len(structure_tp_names)} шт.\n\n"
+                    message += f"🗂️ **Структура сети**\n"
+                    message += f"   ТП: {format_found_count(dual_results['structure_tp_total'])} шт.\n\n"
                 
                 message += "📌 Выберите ТП:\n"
                 message += "• Слева (📄) - просмотр договоров\n"
@@ -2303,7 +3689,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 
                 await update.message.reply_text(
                     message,
-                    reply_markup=get_dual_search_keyboard(registry_tp_names, structure_tp_names),
+                    reply_markup=get_dual_search_keyboard(registry_tp_names, structure_tp_names, dual_results['registry_tp_total'], dual_results['structure_tp_total']),
                     parse_mode='Markdown'
                 )
                 
@@ -2393,10 +3779,11 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     env_key = get_env_key_for_branch(branch, network, is_reference=True)
                     csv_url = os.environ.get(env_key)
                     
+                    tp_results = []
                     if csv_url:
-                        data = load_csv_from_url(csv_url)
+                        await load_csv_from_url_async(csv_url)
                         # Точный поиск по полному названию ТП
-                        tp_results = [r for r in data if r.get('Наименование ТП', '') == full_tp_name]
+                        tp_results = get_tp_rows_from_catalog(csv_url, full_tp_name)
                     
                     logger.info(f"[handle_message] Выбрана ТП из структуры: {full_tp_name}")
                     logger.info(f"[handle_message] Точный поиск нашел записей: {len(tp_results)}")
@@ -2411,8 +3798,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                         user_states[user_id]['network'] = network
                         
                         # ВАЖНО: Получаем ВСЕ уникальные ВЛ
-                        vl_list = list(set([r['Наименование ВЛ'] for r in tp_results]))
-                        vl_list.sort()
+                        vl_list = get_vl_list_from_catalog(csv_url, full_tp_name)
                         
                         logger.info(f"[handle_message] Уникальных ВЛ найдено: {len(vl_list)}")
                         logger.info(f"[handle_message] ВЛ: {vl_list}")
@@ -2436,7 +3822,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             network = user_states[user_id].get('network')
             
             # Проверяем права пользователя
-            user_permissions = get_user_permissions(user_id)
+            user_permissions = permissions
             user_branch = user_permissions.get('branch')
             user_res = user_permissions.get('res')
             
@@ -2508,18 +3894,15 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 )
             else:
                 # Показываем двойную клавиатуру
-                registry_count = len(dual_results['registry'])
-                structure_count = len(dual_results['structure'])
-                
                 message = f"🔍 Результаты поиска по запросу: **{text}**\n\n"
                 
                 if registry_tp_names:
-                    message += f"📋 **Реестр договоров** (найдено {registry_count} записей)\n"
-                    message += f"   ТП: {len(registry_tp_names)} шт.\n\n"
+                    message += f"📋 **Реестр договоров**\n"
+                    message += f"   ТП: {format_found_count(dual_results['registry_tp_total'])} шт.\n\n"
                 
                 if structure_tp_names:
-                    message += f"🗂️ **Структура сети** (найдено {structure_count} записей)\n"
-                    message += f"   ТП: {len(structure_tp_names)} шт.\n\n"
+                    message += f"🗂️ **Структура сети**\n"
+                    message += f"   ТП: {format_found_count(dual_results['structure_tp_total'])} шт.\n\n"
                 
                 message += "📌 Выберите ТП:\n"
                 message += "• Слева (📄) - просмотр договоров\n"
@@ -2527,7 +3910,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 
                 await update.message.reply_text(
                     message,
-                    reply_markup=get_dual_search_keyboard(registry_tp_names, structure_tp_names),
+                    reply_markup=get_dual_search_keyboard(registry_tp_names, structure_tp_names, dual_results['registry_tp_total'], dual_results['structure_tp_total']),
                     parse_mode='Markdown'
                 )
         
@@ -2597,7 +3980,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     network = user_states[user_id].get('network')
                     
                     # Проверяем права пользователя
-                    user_permissions = get_user_permissions(user_id)
+                    user_permissions = permissions
                     user_branch = user_permissions.get('branch')
                     if user_branch and user_branch != 'All':
                         branch = user_branch
@@ -2606,19 +3989,14 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     csv_url = os.environ.get(env_key)
                     
                     if csv_url:
-                        data = load_csv_from_url(csv_url)
-                        # Используем ТОЧНОЕ совпадение для получения ВСЕХ ВЛ
-                        results = [r for r in data if r.get('Наименование ТП', '') == selected_tp]
-                        
-                        # Фильтруем по РЭС если нужно
+                        await load_csv_from_url_async(csv_url)
+                        # Используем ТОЧНОЕ совпадение для получения ВСЕХ ВЛ (с фильтром по РЭС)
                         user_res = user_permissions.get('res')
-                        if user_res and user_res != 'All':
-                            results = [r for r in results if r.get('РЭС', '').strip() == user_res]
                         
-                        if results:
-                            # ВАЖНО: Получаем ВСЕ уникальные ВЛ
-                            vl_list = list(set([r['Наименование ВЛ'] for r in results]))
-                            vl_list.sort()
+                        # ВАЖНО: Получаем ВСЕ уникальные ВЛ
+                        vl_list = get_vl_list_from_catalog(csv_url, selected_tp, user_res)
+                        
+                        if vl_list:
                             
                             logger.info(f"[handle_message] При возврате назад найдено {len(vl_list)} ВЛ")
                             
@@ -2689,7 +4067,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     branch = user_states[user_id].get('branch')
                     network = user_states[user_id].get('network')
                     
-                    user_permissions = get_user_permissions(user_id)
+                    user_permissions = permissions
                     user_branch = user_permissions.get('branch')
                     if user_branch and user_branch != 'All':
                         branch = user_branch
@@ -2698,16 +4076,11 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     csv_url = os.environ.get(env_key)
                     
                     if csv_url:
-                        data = load_csv_from_url(csv_url)
-                        results = [r for r in data if r.get('Наименование ТП', '') == selected_tp]
-                        
+                        await load_csv_from_url_async(csv_url)
                         user_res = user_permissions.get('res')
-                        if user_res and user_res != 'All':
-                            results = [r for r in results if r.get('РЭС', '').strip() == user_res]
+                        vl_list = get_vl_list_from_catalog(csv_url, selected_tp, user_res)
                         
-                        if results:
-                            vl_list = list(set([r['Наименование ВЛ'] for r in results]))
-                            vl_list.sort()
+                        if vl_list:
                             
                             from_dual_search = user_states[user_id].get('from_dual_search', False) 
                             reply_markup = get_vl_selection_keyboard(vl_list, selected_tp, from_dual_search)
@@ -2775,15 +4148,13 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             
             loading_msg = await update.message.reply_text("🔍 Ищу ТП в структуре сети...")
             
-            data = load_csv_from_url(csv_url)
-            results = search_tp_in_data(text, data, 'Наименование ТП')
+            data = await load_csv_from_url_async(csv_url)
             
-            # Фильтруем по РЭС если у пользователя ограничения
-            user_permissions = get_user_permissions(user_id)
+            # Ищем только в разделе РЭС, если у пользователя ограничения
+            user_permissions = permissions
             user_res = user_permissions.get('res')
-            
-            if user_res and user_res != 'All':
-                results = [r for r in results if r.get('РЭС', '').strip() == user_res]
+            ranked = await asyncio.to_thread(search_tp_ranked, text, data, 'Наименование ТП', user_res, TP_SELECTION_TOP_K)
+            results = ranked['rows']
             
             await loading_msg.delete()
             
@@ -2791,8 +4162,9 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await update.message.reply_text("❌ ТП не найдена в справочнике структуры сети")
                 return
             
-            # ВАЖНО: Получаем ВСЕ уникальные ТП
-            tp_list = list(set([r['Наименование ТП'] for r in results]))
+            # ВАЖНО: Получаем лучшие по релевантности уникальные ТП
+            tp_list = ranked['names']
+            tp_total = (ranked['total'], ranked['exact'])
             
             if len(tp_list) == 1:
                 # Если найдена одна ТП
@@ -2810,10 +4182,10 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 user_states[user_id]['notification_results'] = results
                 user_states[user_id]['action'] = 'select_notification_tp'
                 
-                reply_markup = get_tp_selection_keyboard(tp_list)
+                reply_markup = get_tp_selection_keyboard(tp_list, tp_total)
                 
                 await update.message.reply_text(
-                    f"✅ Найдено {len(tp_list)} ТП. Выберите нужную:",
+                    f"✅ Найдено {format_found_count(tp_total)} ТП. Выберите нужную:",
                     reply_markup=reply_markup
                 )
         
@@ -2829,42 +4201,15 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             csv_url = os.environ.get(env_key)
             
             if csv_url:
-                data = load_csv_from_url(csv_url)
-                
-                # ИЗМЕНЕНО: Ищем как по точному совпадению, так и по очищенному названию
-                tp_results = []
-                
-                # Сначала пробуем точное совпадение
-                tp_results = [r for r in data if r.get('Наименование ТП', '') == text]
-                
-                # Если не нашли - ищем без учета префиксов
-                if not tp_results:
-                    # Убираем префикс из выбранного текста
-                    text_clean = re.sub(r'^\d+\)\s*', '', text)
-                    
-                    for row in data:
-                        tp_name = row.get('Наименование ТП', '')
-                        tp_name_clean = re.sub(r'^\d+\)\s*', '', tp_name)
-                        
-                        # Сравниваем очищенные версии
-                        if tp_name_clean == text_clean or tp_name == text:
-                            tp_results.append(row)
+                await load_csv_from_url_async(csv_url)
                 
-                # Фильтруем по РЭС если нужно
-                user_permissions = get_user_permissions(user_id)
+                # Ищем по точному совпадению, а если не нашли - по названию без префикса "1)",
+                # с фильтром по РЭС если нужно
+                user_permissions = permissions
                 user_res = user_permissions.get('res')
-                if user_res and user_res != 'All':
-                    # ИСПРАВЛЕНО: Фильтруем tp_results, а не results!
-                    tp_results = [r for r in tp_results if r.get('РЭС', '').strip() == user_res]
+                tp_results = get_tp_rows_from_catalog(csv_url, text, user_res, match_clean_name=True)
                 
                 logger.info(f"[select_notification_tp] Точный поиск для '{text}' нашел {len(tp_results)} записей")
-                
-                # ДОБАВЛЕНО: Логирование для отладки
-                if tp_results:
-                    vl_names = [r.get('Наименование ВЛ', '') for r in tp_results]
-                    unique_vl = list(set(vl_names))
-                    logger.info(f"[select_notification_tp] Всего записей: {len(tp_results)}, уникальных ВЛ: {len(unique_vl)}")
-                    logger.info(f"[select_notification_tp] Примеры ВЛ: {unique_vl[:5]}")
                     
             else:
                 # Если не удалось загрузить - используем исходные результаты
@@ -2878,9 +4223,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 user_states[user_id]['tp_data'] = tp_results[0]
                 user_states[user_id]['action'] = 'select_vl'
                 
-                # ВАЖНО: Получаем ВСЕ уникальные ВЛ
-                vl_list = list(set([r['Наименование ВЛ'] for r in tp_results]))
-                vl_list.sort()
+                # ВАЖНО: Получаем ВСЕ уникальные ВЛ (по очищенному названию могут совпасть разные ТП)
+                vl_list = get_unique_vl_list(tp_results)
                 
                 logger.info(f"[select_notification_tp] Найдено {len(vl_list)} уникальных ВЛ")
                 logger.info(f"[select_notification_tp] ВЛ: {vl_list[:10]}...")  # Показываем первые 10 для отладки
@@ -2921,12 +4265,12 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     message = f"🔍 Результаты поиска по запросу: **{search_query}**\n\n"
                     
                     if registry_tp_names:
-                        message += f"📋 **Реестр договоров** (найдено {len(dual_results['registry'])} записей)\n"
-                        message += f"   ТП: {len(registry_tp_names)} шт.\n\n"
+                        message += f"📋 **Реестр договоров**\n"
+                        message += f"   ТП: {format_found_count(dual_results['registry_tp_total'])} шт.\n\n"
                     
                     if structure_tp_names:
-                        message += f"🗂️ **Структура сети** (найдено {len(dual_results['structure'])} записей)\n"
-                        message += f"   ТП: {len(structure_tp_names)} шт.\n\n"
+                        message += f"🗂️ **Структура сети**\n"
+                        message += f"   ТП: {format_found_count(dual_results['structure_tp_total'])} шт.\n\n"
                     
                     message += "📌 Выберите ТП:\n"
                     message += "• Слева (📄) - просмотр договоров\n"
@@ -2934,7 +4278,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     
                     await update.message.reply_text(
                         message,
-                        reply_markup=get_dual_search_keyboard(registry_tp_names, structure_tp_names),
+                        reply_markup=get_dual_search_keyboard(registry_tp_names, structure_tp_names, dual_results['registry_tp_total'], dual_results['structure_tp_total']),
                         parse_mode='Markdown'
                     )
                 else:
@@ -2964,7 +4308,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     reply_markup=get_comment_keyboard()
                 )
             elif text == '📤 Отправить без фото и комментария':
-                await send_notification(update, context)
+                await send_notification(update, context, permissions)
         
         elif action == 'request_photo':
             # Обработка текста при запросе фото
@@ -2975,16 +4319,16 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     reply_markup=get_comment_keyboard()
                 )
             elif text == '📤 Отправить без фото и комментария':
-                await send_notification(update, context)
+                await send_notification(update, context, permissions)
         
         elif action == 'add_comment':
             # Обработка комментария
             if text == '📤 Отправить без комментария':
-                await send_notification(update, context)
+                await send_notification(update, context, permissions)
             else:
                 # Сохраняем комментарий
                 user_states[user_id]['comment'] = text
-                await send_notification(update, context)
+                await send_notification(update, context, permissions)
     
     # ==================== ОБРАБОТКА ОТЧЕТОВ ====================
     elif state == 'reports':
@@ -3375,7 +4719,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         elif text == '📋 Весь реестр':
             # Загружаем данные контрагентов
-            contractors_data = load_contractors_data()
+            contractors_data = await load_contractors_data()
             if not contractors_data:
                 await update.message.reply_text(
                     "❌ Не удалось загрузить справочник контрагентов",
@@ -3408,7 +4752,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     elif state == 'phone_book_search':
         # Поиск контрагента
-        contractors_data = load_contractors_data()
+        contractors_data = await load_contractors_data()
         if not contractors_data:
             await update.message.reply_text(
                 "❌ Не удалось загрузить справочник контрагентов",
@@ -3763,7 +5107,7 @@ async def generate_activity_report(update: Update, context: ContextTypes.DEFAULT
     # Собираем данные об активности - БЕЗ ID!
     activity_data = []
     for uid, activity in user_activity.items():
-        user_data = users_cache.get(uid, {})
+        user_data = users_snapshot.users.get(uid, {})
         if network == 'RK' and user_data.get('visibility') in ['All', 'RK']:
             activity_data.append({
                 'ФИО': user_data.get('name', 'Неизвестный'),
@@ -3859,12 +5203,13 @@ async def generate_ping_report(update: Update, context: ContextTypes.DEFAULT_TYP
     loading_msg = await update.message.reply_text("🔄 Проверяю статус пользователей...")
     
     ping_data = []
-    total_users = len(users_cache)
+    users = users_snapshot.users
+    total_users = len(users)
     active_users = 0
     blocked_users = 0
     never_started = 0
     
-    for uid, user_data in users_cache.items():
+    for uid, user_data in users.items():
         status = "❓ Неизвестно"
         last_activity = "-"
         
@@ -4026,7 +5371,7 @@ async def handle_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
         recipients = list(bot_users.keys())
         recipients_name = "пользователям, запускавшим бота"
     else:
-        recipients = list(users_cache.keys())
+        recipients = list(users_snapshot.users.keys())
         recipients_name = "всем пользователям из базы"
     
     loading_msg = await update.message.reply_text(
@@ -4099,29 +5444,43 @@ async def preload_documents():
     logger.info("✅ Предзагрузка документов завершена")
 
 async def refresh_users_data():
-    """Периодическое обновление данных пользователей"""
+    """Периодическое обновление данных пользователей (и внеочередное по request_users_reload)"""
     while True:
-        await asyncio.sleep(300)  # Каждые 5 минут
-        logger.info("🔄 Обновляем данные пользователей...")
         try:
-            load_users_data()
-            logger.info("✅ Данные пользователей обновлены")
+            await asyncio.wait_for(users_reload_event.wait(), timeout=USERS_REFRESH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        users_reload_event.clear()
+        waiters = users_reload_waiters[:]
+        users_reload_waiters.clear()
+        
+        logger.info("🔄 Проверяем данные пользователей...")
+        try:
+            changed = await refresh_users_data_if_changed()
+            if changed:
+                logger.info(f"✅ Данные пользователей обновлены (версия {users_snapshot.version})")
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_result(changed)
         except Exception as e:
             logger.error(f"❌ Ошибка обновления данных пользователей: {e}")
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_exception(e)
 
 async def save_bot_users_periodically():
     """Периодическое сохранение данных о пользователях бота"""
     while True:
         await asyncio.sleep(120)  # Каждые 2 минуты вместо 10
         
-        # Сохраняем только если есть что сохранять
-        if bot_users:
-            if save_bot_users():
+        # Сохраняем только если есть несохраненные изменения (например, после ошибки записи)
+        if bot_users_generation > bot_users_saved_generation:
+            if await save_bot_users_async():
                 logger.info(f"⏰ Автосохранение: сохранено {len(bot_users)} пользователей")
             else:
                 logger.error("❌ Ошибка автосохранения данных пользователей")
         else:
-            logger.debug("⏰ Автосохранение: нет данных для сохранения")
+            logger.debug("⏰ Автосохранение: нет изменений для сохранения")
 
 async def refresh_documents_cache():
     """Периодическое обновление кэша документов"""
@@ -4176,6 +5535,15 @@ async def init_and_start():
     logger.info(f"🚀 ЗАПУСК БОТА ВОЛС АССИСТЕНТ v{BOT_VERSION}")
     logger.info("=" * 60)
     
+    configure_gc_for_catalogs()
+    
+    # Восстанавливаем справочники из снимков (свежие версии догрузятся в фоне)
+    await restore_csv_snapshots()
+    
+    # Загружаем пользователей (нужны для проверки прав)
+    logger.info("📊 Загружаем данные пользователей...")
+    await load_users_data()
+    
     # Загружаем документы
     logger.info("📄 Начинаем предзагрузку документов...")
     await preload_documents()
@@ -4187,7 +5555,7 @@ async def init_and_start():
     # Выводим статистику
     logger.info("=" * 60)
     logger.info("📈 СТАТИСТИКА ПОСЛЕ ЗАГРУЗКИ:")
-    logger.info(f"👥 Пользователей в базе (CSV): {len(users_cache)}")
+    logger.info(f"👥 Пользователей в базе (CSV): {len(users_snapshot.users)}")
     logger.info(f"🔄 Пользователей запускавших бота: {len(bot_users)}")
     logger.info(f"📁 CSV файлов в кэше: {len(csv_cache)}")
     logger.info(f"📄 Документов в кэше: {len(documents_cache)}")
@@ -4197,6 +5565,7 @@ async def init_and_start():
     logger.info("⚙️ Запускаем фоновые задачи...")
     asyncio.create_task(refresh_documents_cache())
     asyncio.create_task(refresh_users_data())
+    asyncio.create_task(refresh_csv_cache_periodically())
     asyncio.create_task(save_bot_users_periodically())
     
     logger.info("✅ Инициализация завершена!")
@@ -4233,14 +5602,13 @@ if __name__ == '__main__':
     application.add_handler(MessageHandler(filters.PHOTO, handle_photo))
     application.add_error_handler(error_handler)
     
-    # Загружаем данные
-    logger.info("📊 Загружаем данные пользователей...")
-    load_users_data()
+    # Загружаем данные (пользователи загружаются асинхронно в init_and_start)
     logger.info("💾 Загружаем историю запусков бота...")
     load_bot_users()
     
     async def post_init(application: Application) -> None:
         """Вызывается после инициализации приложения"""
+        get_http_session()
         await init_and_start()
     
     async def post_shutdown(application: Application) -> None:
@@ -4248,6 +5616,8 @@ if __name__ == '__main__':
         logger.info("🛑 Сохраняем данные перед остановкой...")
         save_bot_users()
         logger.info("✅ Данные сохранены")
+        await close_http_session()
+        shutdown_csv_parse_executor()
     
     application.post_init = post_init
     if hasattr(application, 'post_shutdown'):
@@ -0,0 +1,72 @@
+"""Общие фикстуры тестов: локальный HTTP-сервер вместо Google Sheets и чистый кэш CSV"""
+import asyncio
+import os
+import sys
+import time
+from contextlib import asynccontextmanager
+
+import pytest
+from aiohttp import web
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+CSV_STATE = (
+    'csv_cache', 'csv_cache_time', 'csv_cache_meta', 'csv_cache_version', 'csv_refresh_tasks',
+    'csv_fetch_tasks', 'csv_cache_size', 'csv_cache_last_access', 'csv_refresh_stats',
+    'csv_index_cache', 'search_results_cache',
+)
+
+
+@pytest.fixture(autouse=True)
+def clean_csv_cache(tmp_path, monkeypatch):
+    """Каждый тест начинает с пустого кэша CSV и своим каталогом снимков"""
+    monkeypatch.setattr(main, 'CSV_SNAPSHOT_DIR', str(tmp_path / 'csv_snapshots'))
+    for name in CSV_STATE:
+        getattr(main, name).clear()
+    yield
+    for name in CSV_STATE:
+        getattr(main, name).clear()
+    main.shutdown_csv_parse_executor()
+
+
+@asynccontextmanager
+async def csv_server(handlers):
+    """Локальный сервер: путь -> обработчик aiohttp; отдает базовый URL"""
+    app = web.Application()
+    for path, handler in handlers.items():
+        app.router.add_get(path, handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    try:
+        yield f'http://127.0.0.1:{port}'
+    finally:
+        await main.close_http_session()
+        await runner.cleanup()
+
+
+@asynccontextmanager
+async def heartbeat(interval=0.005):
+    """Задача, которая тикает каждые interval секунд; отдает список промежутков между тиками"""
+    gaps = []
+    stopped = asyncio.Event()
+
+    async def beat():
+        last = time.perf_counter()
+        while not stopped.is_set():
+            await asyncio.sleep(interval)
+            now = time.perf_counter()
+            gaps.append(now - last)
+            last = now
+
+    task = asyncio.create_task(beat())
+    try:
+        yield gaps
+    finally:
+        stopped.set()
+        await task
@@ -0,0 +1,149 @@
+"""Загрузка CSV-справочников: асинхронное скачивание без блокировки event loop"""
+import asyncio
+import time
+
+from aiohttp import web
+
+import main
+from conftest import csv_server, heartbeat
+
+
+def test_slow_download_keeps_event_loop_responsive():
+    """Пока медленный сервер отдает CSV с BOM, event loop продолжает тикать"""
+    rows = ['Наименование ТП,РЭС,Наименование ВЛ'] + [f'ТП-{i},Тимашевский,ВЛ-{i % 7}' for i in range(500)]
+    body = ('﻿' + '\n'.join(rows) + '\n').encode('utf-8')
+
+    async def slow_csv(request):
+        response = web.StreamResponse()
+        await response.prepare(request)
+        for start in range(0, len(body), 1024):
+            await response.write(body[start:start + 1024])
+            await asyncio.sleep(0.02)
+        await response.write_eof()
+        return response
+
+    async def scenario():
+        async with csv_server({'/slow.csv': slow_csv}) as base:
+            async with heartbeat() as gaps:
+                started = time.perf_counter()
+                data = await main.load_csv_from_url_async(f'{base}/slow.csv')
+                elapsed = time.perf_counter() - started
+        return data, gaps, elapsed
+
+    data, gaps, elapsed = asyncio.run(scenario())
+
+    assert elapsed > 0.2
+    assert len(data) == 500
+    assert list(data[0].keys()) == ['Наименование ТП', 'РЭС', 'Наименование ВЛ']
+    assert data[0]['Наименование ТП'] == 'ТП-0'
+    assert max(gaps) < 0.1
+
+
+def test_concurrent_loads_share_one_request():
+    """Десять одновременных загрузок одного URL - один запрос и один и тот же список строк"""
+    hits = []
+
+    async def catalog_csv(request):
+        hits.append(request.path)
+        await asyncio.sleep(0.2)
+        return web.Response(body='﻿Наименование ТП,РЭС\nТП-1,Тимашевский\nТП-2,Брюховецкий\n'.encode('utf-8'))
+
+    async def scenario():
+        async with csv_server({'/catalog.csv': catalog_csv}) as base:
+            url = f'{base}/catalog.csv'
+            return await asyncio.gather(*(main.load_csv_from_url_async(url) for _ in range(10)))
+
+    results = asyncio.run(scenario())
+
+    assert hits == ['/catalog.csv']
+    assert all(result is results[0] for result in results)
+    assert len(results[0]) == 2
+    assert not main.csv_fetch_tasks
+
+
+def test_failing_url_makes_one_request():
+    """Ошибка сервера тоже приходит всем ожидающим из одного запроса"""
+    hits = []
+
+    async def broken_csv(request):
+        hits.append(request.path)
+        await asyncio.sleep(0.2)
+        return web.Response(status=503)
+
+    async def scenario():
+        async with csv_server({'/broken.csv': broken_csv}) as base:
+            url = f'{base}/broken.csv'
+            return await asyncio.gather(*(main.load_csv_from_url_async(url) for _ in range(5)))
+
+    results = asyncio.run(scenario())
+
+    assert hits == ['/broken.csv']
+    assert results == [[]] * 5
+    assert not main.csv_fetch_tasks
+
+
+def test_not_modified_after_eviction_keeps_snapshot():
+    """304 для вытесненного за время запроса справочника не превращается в пустой справочник"""
+    body = '﻿Наименование ТП,РЭС\nТП-1,Тимашевский\nТП-2,Брюховецкий\n'.encode('utf-8')
+    url_holder = []
+
+    async def catalog_csv(request):
+        if request.headers.get('If-None-Match') == '"v1"':
+            # Пока шел условный запрос, справочник вытеснили из памяти
+            main.evict_csv_cache_entry(url_holder[0])
+            return web.Response(status=304)
+        return web.Response(body=body, headers={'ETag': '"v1"'})
+
+    async def scenario():
+        async with csv_server({'/catalog.csv': catalog_csv}) as base:
+            url = f'{base}/catalog.csv'
+            url_holder.append(url)
+            await main.load_csv_from_url_async(url)
+            await main.refresh_csv(url)
+            return url
+
+    url = asyncio.run(scenario())
+
+    assert url not in main.csv_cache
+    assert main.csv_refresh_stats[url]['refreshes'] == 0
+    assert main.csv_refresh_stats[url]['failures'] == 1
+    snapshot = main.load_csv_snapshot(main.get_csv_snapshot_path(url))
+    assert len(snapshot['data']) == 2
+
+
+def test_background_refresh_does_not_touch_lru_or_revive_evicted():
+    """Фоновое обновление не делает справочник недавно использованным и не возвращает вытесненный"""
+    bodies = [
+        '﻿Наименование ТП,РЭС\nТП-1,Тимашевский\n'.encode('utf-8'),
+        '﻿Наименование ТП,РЭС\nТП-1,Тимашевский\nТП-2,Брюховецкий\n'.encode('utf-8'),
+        '﻿Наименование ТП,РЭС\nТП-3,Калининский\n'.encode('utf-8'),
+    ]
+    evict_during_request = []
+
+    async def catalog_csv(request):
+        if evict_during_request:
+            main.evict_csv_cache_entry(evict_during_request.pop())
+        return web.Response(body=bodies[0])
+
+    async def scenario():
+        async with csv_server({'/catalog.csv': catalog_csv}) as base:
+            url = f'{base}/catalog.csv'
+            await main.load_csv_from_url_async(url)
+            main.csv_cache_last_access[url] = 0.0
+
+            bodies.pop(0)
+            await main.refresh_csv(url)
+            refreshed_rows = len(main.csv_cache[url])
+            last_access = main.csv_cache_last_access.get(url)
+
+            bodies.pop(0)
+            evict_during_request.append(url)
+            await main.refresh_csv(url)
+            return url, refreshed_rows, last_access
+
+    url, refreshed_rows, last_access = asyncio.run(scenario())
+
+    assert refreshed_rows == 2
+    assert last_access == 0.0
+    assert url not in main.csv_cache
+    assert url not in main.csv_index_cache
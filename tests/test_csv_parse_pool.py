@@ -0,0 +1,74 @@
+"""Разбор CSV и построение индекса в пуле: event loop не стоит, пока обновляется большой справочник"""
+import asyncio
+import gc
+import random
+import time
+
+import pytest
+from aiohttp import web
+
+import main
+from conftest import csv_server, heartbeat
+
+
+def make_catalog_csv(rows: int, seed: int) -> bytes:
+    """Справочник ТП заданного размера в том виде, в каком его отдает Google Sheets"""
+    rng = random.Random(seed)
+    stations = ['Южная', 'Северная', 'Лесная', 'Центр', 'Садовая']
+    lines = ['Филиал,РЭС,Наименование ТП,Наименование ВЛ,Опоры,Наименование Провайдера']
+    for _ in range(rows):
+        tp = rng.choice([
+            f'ТП-{rng.randint(1, 9999)}',
+            f'КТП-10-{rng.randint(1, 999)} ПС {rng.choice(stations)}',
+            f'КЛ-10 кВ ПС {rng.choice(stations)} яч.{rng.randint(1, 20)}',
+        ])
+        lines.append(
+            f'Тимашевские ЭС,{rng.choice(["Тимашевский", "Брюховецкий", "Калининский"])},{tp},'
+            f'ВЛ-0.4 кВ Ф-{rng.randint(1, 9)},{rng.randint(1, 50)}-{rng.randint(51, 99)},ПАО Ростелеком'
+        )
+    return ('﻿' + '\n'.join(lines) + '\n').encode('utf-8')
+
+
+@pytest.fixture
+def bot_gc_settings():
+    """Настройки GC, которые бот выставляет при запуске (после теста - прежние)"""
+    threshold = gc.get_threshold()
+    main.configure_gc_for_catalogs()
+    yield
+    gc.set_threshold(*threshold)
+
+
+@pytest.mark.usefixtures('bot_gc_settings')
+@pytest.mark.parametrize('executor', ['thread', 'process'])
+def test_big_catalog_refresh_keeps_event_loop_responsive(executor, monkeypatch):
+    """Обновление справочника на 30 тысяч строк почти не задерживает heartbeat"""
+    monkeypatch.setattr(main, 'CSV_PARSE_EXECUTOR', executor)
+    bodies = [make_catalog_csv(30000, seed=1), make_catalog_csv(30000, seed=2)]
+
+    async def catalog_csv(request):
+        return web.Response(body=bodies[0])
+
+    async def scenario():
+        async with csv_server({'/big.csv': catalog_csv}) as base:
+            url = f'{base}/big.csv'
+            await main.load_csv_from_url_async(url)
+            old_rows = main.csv_cache[url]
+
+            bodies.pop(0)
+            async with heartbeat() as gaps:
+                started = time.perf_counter()
+                await main.refresh_csv(url)
+                elapsed = time.perf_counter() - started
+            return url, old_rows, gaps, elapsed
+
+    url, old_rows, gaps, elapsed = asyncio.run(scenario())
+    gaps.sort()
+    lag = {'max': gaps[-1], 'p99': gaps[int(len(gaps) * 0.99)], 'elapsed': elapsed}
+
+    assert main.csv_refresh_stats[url]['refreshes'] == 1
+    assert main.csv_cache[url] is not old_rows
+    assert len(main.csv_cache[url]) == 30000
+    assert isinstance(main.csv_cache[url], tuple)
+    # Без пула весь разбор шел одним куском: задержка loop была равна времени обновления
+    assert lag['max'] < elapsed / 2
+    assert lag['p99'] < 0.25
@@ -0,0 +1,188 @@
+"""Ранжированный поиск ТП: порядок, число найденных и раздел РЭС"""
+import random
+import re
+
+import pytest
+
+import main
+
+
+def make_rows(names, res='Тимашевский'):
+    return [{'Наименование ТП': name, 'РЭС': res, 'Наименование ВЛ': 'ВЛ-0.4 кВ Ф-1'} for name in names]
+
+
+@pytest.mark.parametrize('query', ['ТП', 'ТП-1', 'ТП-10'])
+@pytest.mark.parametrize('limit', [18, 19, 20])
+def test_found_count_is_exact_when_all_names_fit(query, limit, monkeypatch):
+    """Ровно 19 подходящих ТП - "19", а не "19+", даже если limit тоже 19"""
+    monkeypatch.setattr(main, 'TP_FUZZY_SEARCH_ENABLED', False)
+    data = make_rows([f'ТП-{1000 + i}' for i in range(19)] + [f'РП-{i}' for i in range(50)])
+
+    found = main.search_tp_ranked(query, data, 'Наименование ТП', limit=limit)
+
+    assert found['names'] == [f'ТП-{1000 + i}' for i in range(min(limit, 19))]
+    assert found['total'] == 19
+    assert found['exact'] == (limit >= 19)
+
+
+STATIONS = ['Южная', 'Северная', 'Кавказ', 'Лесная', 'Центр', 'Ахтари', 'НПС']
+RES = ['Тимашевский', 'Брюховецкий', 'Приморско-Ахтарский', 'Калининский']
+QUERIES = [
+    'ТП-1234', '1234', 'тп 12', 'ТП', 'КЛ-10 кВ ПС Южная', 'КЛ 10', 'Южная', 'ЗТП-5', 'РП3', '12-3',
+    'ктп 10 55', 'ТП;12', 'п', 'КТП-10-1', 'Ахтари', 'КЛ', 'мтп 9', '99', '1', 'ТП 1/2', '5 ПС', 'НПС',
+    'СТП-77', 'кл 35 кавказ', '2)', 'ТП-12-34',
+]
+
+
+def make_tp_name(rng):
+    """Название ТП в одном из встречающихся в справочниках написаний"""
+    prefix = rng.choice(['ТП', 'КТП', 'ЗТП', 'РП', 'МТП', 'СТП', 'КЛ', 'ТП'])
+    number = rng.randint(1, 9999)
+    if prefix == 'КЛ':
+        return rng.choice([
+            f'КЛ-{rng.choice([6, 10, 35])} кВ ПС {rng.choice(STATIONS)}',
+            f'КЛ {rng.choice([6, 10])}кВ {rng.choice(STATIONS)} яч.{rng.randint(1, 20)}',
+            f'КЛ-10 ПС-{rng.choice(STATIONS)}-{number}',
+        ])
+    return rng.choice([
+        f'{prefix}-{number}',
+        f'{rng.randint(1, 9)}) {prefix} {number}/{rng.randint(1, 9)}',
+        f'{prefix}-{rng.choice([6, 10])}-{number} ПС {rng.choice(STATIONS)}',
+        f'{prefix}{number};{rng.randint(1, 99)}',
+        f'{prefix} {rng.choice(STATIONS)}-{number}',
+        f'{prefix}--{number}  {rng.randint(10, 99)}',
+    ])
+
+
+@pytest.fixture(scope='module')
+def catalog():
+    """Синтетический справочник: 600 названий ТП на 2000 строк в разных РЭС"""
+    rng = random.Random(7)
+    names = [make_tp_name(rng) for _ in range(600)]
+    return [
+        {'РЭС': rng.choice(RES), 'Наименование ТП': rng.choice(names), 'Наименование ВЛ': f'ВЛ-0,4 кВ Ф-{rng.randint(1, 9)}'}
+        for _ in range(2000)
+    ]
+
+
+def cascade_score(tp_query, tp_name):
+    """Исходный каскад правил search_tp_in_data_advanced для одной строки (оценка сработавшего правила)"""
+    normalized_query = main.normalize_tp_name_advanced(tp_query)
+    query_compact = normalized_query.replace('-', '').replace(' ', '').replace('/', '')
+    query_simplified = main.simplify_cable_name(normalized_query)
+    query_letter_parts = re.findall(r'[А-ЯA-Z]+', query_compact)
+    query_digit_parts = re.findall(r'\d+', query_compact)
+
+    normalized_tp = main.normalize_tp_name_advanced(re.sub(r'^\d+\)\s*', '', tp_name))
+    tp_compact = normalized_tp.replace('-', '').replace(' ', '').replace('/', '')
+    tp_simplified = main.simplify_cable_name(normalized_tp)
+    tp_letter_parts = re.findall(r'[А-ЯA-Z]+', tp_compact)
+    tp_digit_parts = re.findall(r'\d+', tp_compact)
+
+    if normalized_query == normalized_tp:
+        return main.TP_SCORE_EXACT
+    if query_compact == tp_compact:
+        return main.TP_SCORE_COMPACT_EXACT
+    if query_simplified and tp_simplified and query_simplified in tp_simplified:
+        return main.TP_SCORE_CABLE_SIMPLIFIED
+    if len(query_compact) >= 4 and query_compact in tp_compact:
+        return main.TP_SCORE_SUBSTRING
+    if ('КЛ' in normalized_query or 'КЛ' in normalized_tp) and main.cable_params_match(
+            main.extract_cable_params(normalized_query), main.extract_cable_params(normalized_tp)):
+        return main.TP_SCORE_PART_MATCH
+
+    if query_letter_parts:
+        for query_letters in query_letter_parts:
+            if not any(query_letters in tp_letters or tp_letters in query_letters for tp_letters in tp_letter_parts):
+                return 0
+        if not query_digit_parts:
+            return main.TP_SCORE_PART_MATCH
+        if len(query_digit_parts) == 1:
+            found = any(tp_digit.startswith(query_digit_parts[0]) for tp_digit in tp_digit_parts)
+        else:
+            found = len(query_digit_parts) <= len(tp_digit_parts) and all(
+                tp_digit_parts[i].startswith(query_digit) for i, query_digit in enumerate(query_digit_parts))
+        return main.TP_SCORE_PART_MATCH if found else 0
+    if query_digit_parts:
+        query_digits = ''.join(query_digit_parts)
+        if any(tp_digit.startswith(query_digits) for tp_digit in tp_digit_parts):
+            return main.TP_SCORE_PART_MATCH
+    return 0
+
+
+@pytest.mark.parametrize('user_res', [None, 'Тимашевский', 'Нет такого'])
+def test_ranked_search_finds_same_tp_as_original_cascade(catalog, user_res, monkeypatch):
+    """Индекс находит те же ТП, что и полный перебор по исходному каскаду, лучшие - первыми"""
+    monkeypatch.setattr(main, 'TP_FUZZY_SEARCH_ENABLED', False)
+    main.store_csv_in_cache('http://catalog/tp.csv', catalog)
+
+    for tp_query in QUERIES:
+        rows = [row for row in catalog if not user_res or row['РЭС'] == user_res]
+        scores = {}
+        for row in rows:
+            score = cascade_score(tp_query, row['Наименование ТП'])
+            if score:
+                scores[row['Наименование ТП']] = score
+
+        found = main.search_tp_ranked(tp_query, catalog, 'Наименование ТП', user_res, limit=len(catalog))
+
+        assert set(found['names']) == set(scores), tp_query
+        assert (found['total'], found['exact']) == (len(scores), True), tp_query
+        found_scores = [scores[name] for name in found['names']]
+        assert found_scores == sorted(found_scores, reverse=True), tp_query
+        assert sorted(map(id, found['rows'])) == sorted(id(row) for row in rows if row['Наименование ТП'] in scores), tp_query
+
+
+def test_res_filter_keeps_only_rows_of_user_res():
+    """Пользователь с ограничением по РЭС не видит строки и ВЛ других РЭС той же ТП"""
+    data = [
+        {'РЭС': 'Тимашевский', 'Наименование ТП': 'ТП-101', 'Наименование ВЛ': 'ВЛ-0.4 кВ Ф-1'},
+        {'РЭС': 'Брюховецкий', 'Наименование ТП': 'ТП-101', 'Наименование ВЛ': 'ВЛ-0.4 кВ Ф-2'},
+        {'РЭС': 'Брюховецкий', 'Наименование ТП': 'ТП-102', 'Наименование ВЛ': 'ВЛ-0.4 кВ Ф-3'},
+    ]
+    url = 'http://catalog/tp.csv'
+    main.store_csv_in_cache(url, data)
+
+    found = main.search_tp_ranked('ТП-10', data, 'Наименование ТП', 'Тимашевский')
+
+    assert found['names'] == ['ТП-101']
+    assert found['rows'] == [data[0]]
+    assert main.get_tp_rows_from_catalog(url, 'ТП-101', 'Тимашевский') == [data[0]]
+    assert main.get_vl_list_from_catalog(url, 'ТП-101', 'Тимашевский') == ['ВЛ-0.4 кВ Ф-1']
+    assert main.get_vl_list_from_catalog(url, 'ТП-101') == ['ВЛ-0.4 кВ Ф-1', 'ВЛ-0.4 кВ Ф-2']
+    assert main.search_tp_ranked('ТП-10', data, 'Наименование ТП', 'Крымский')['names'] == []
+
+
+def test_fuzzy_dictionary_is_built_with_the_index(monkeypatch):
+    """Словарь опечаток готов сразу после загрузки справочника, первый нечеткий запрос его не строит"""
+    monkeypatch.setattr(main, 'TP_FUZZY_SEARCH_ENABLED', True)
+    data = make_rows(['ТП-1234', 'ТП-5678'])
+    main.store_csv_in_cache('http://catalog/tp.csv', data)
+    deletes = main.csv_index_cache['http://catalog/tp.csv']['fuzzy_deletes']
+
+    found = main.search_tp_ranked('ТП-1243', data, 'Наименование ТП')
+
+    assert deletes is not None
+    assert main.csv_index_cache['http://catalog/tp.csv']['fuzzy_deletes'] is deletes
+    assert found['names'] == ['ТП-1234']
+
+
+@pytest.mark.parametrize('user_res', [None, 'Тимашевский', 'Нет такого'])
+@pytest.mark.parametrize('limit', [1, 5, 19])
+def test_pandas_engine_matches_index_engine(catalog, user_res, limit, monkeypatch):
+    """TP_SEARCH_ENGINE=pandas и инвертированный индекс дают одинаковые лучшие ТП"""
+    monkeypatch.setattr(main, 'TP_FUZZY_SEARCH_ENABLED', False)
+    main.store_csv_in_cache('http://catalog/tp.csv', catalog)
+    index = main.csv_index_cache['http://catalog/tp.csv']
+
+    for tp_query in QUERIES:
+        found = {}
+        for engine in ('index', 'pandas'):
+            monkeypatch.setattr(main, 'TP_SEARCH_ENGINE', engine)
+            found[engine] = main.rank_tp_names_in_index(tp_query, index, user_res, limit)
+
+        names, rows, total, exact = found['index']
+        pandas_names, pandas_rows, pandas_total, pandas_exact = found['pandas']
+        assert (names, rows, exact) == (pandas_names, pandas_rows, pandas_exact), tp_query
+        # Индекс останавливается досрочно - его число найденных только нижняя граница
+        assert total == pandas_total if exact else total <= pandas_total, tp_query